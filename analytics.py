@@ -0,0 +1,245 @@
+from typing import Any, Dict, Iterable, List, Optional, Union
+from pathlib import Path
+import ast
+import csv
+import json
+import logging
+import numpy as np
+from answers import decode_colors, decode_value
+
+
+class ResultTable:
+    """ Result rows as columnar arrays of integer codes
+
+    Workers, items (num_cubes, ref) and answers are factorized while the
+    files are read, so the group-bys are bincounts over small integers.
+    Answers are normalized once per distinct raw value.
+    """
+
+    def __init__(self):
+        self.workers: List[str] = []
+        self.items: List[tuple] = []
+        self.answers: List[str] = []
+        self.worker = np.zeros(0, dtype=np.int64)
+        self.item = np.zeros(0, dtype=np.int64)
+        self.answer = np.zeros(0, dtype=np.int64)
+        # Code of the ground-truth answer of each item, -1 when unknown
+        self.truth = np.zeros(0, dtype=np.int64)
+        self._answer_codes: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.worker)
+
+    def answer_code(self, answer: str) -> int:
+        code = self._answer_codes.get(answer)
+        if code is None:
+            code = self._answer_codes[answer] = len(self.answers)
+            self.answers.append(answer)
+        return code
+
+
+def normalize_answer(value: Any) -> str:
+    """ Canonical text of an answer, so that equal answers compare equal
+
+    Color indices from the check template become color names from bottom
+    to top; names are lowercased; anything else is stripped text.
+    """
+    if isinstance(value, str):
+        value = decode_value(value)
+    if isinstance(value, str) and value.startswith('['):
+        # cli.py ground-truth writes the colors as a Python list
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass
+    if isinstance(value, dict):
+        value = value['output'] if 'output' in value else value
+    if isinstance(value, list):
+        if all(isinstance(v, int) for v in value):
+            value = decode_colors(value)
+        if all(v is None or isinstance(v, str) for v in value):
+            return json.dumps([v.lower() if v else v for v in value])
+        return json.dumps(value, sort_keys=True)
+    return str(value).strip().lower()
+
+
+def load_results(files: Iterable[Union[Path, str]],
+                 ground_truth: Optional[Any] = None) -> ResultTable:
+    """ Read the result CSVs into a ResultTable
+
+    The ground truth of an item comes from its ground_truth column (see
+    cli.py ground-truth) or from `ground_truth.get(num_cubes, ref)`.
+    """
+    table = ResultTable()
+    worker_codes: Dict[str, int] = {}
+    item_codes: Dict[tuple, int] = {}
+    raw_codes: Dict[str, int] = {}
+    truths: Dict[int, Any] = {}
+    workers, items, raws = [], [], []
+    seen = set()
+
+    for filename in files:
+        with open(filename, 'r', newline='') as fid:
+            for row in csv.DictReader(fid, delimiter=','):
+                key = (int(row['numCubes']), int(row['ref']))
+                # The same assignment may be listed in several files
+                if (row['assignment_id'], key) in seen:
+                    continue
+                seen.add((row['assignment_id'], key))
+                item = item_codes.setdefault(key, len(item_codes))
+                if item not in truths and row.get('ground_truth'):
+                    truths[item] = row['ground_truth']
+                workers.append(worker_codes.setdefault(row['worker_id'], len(worker_codes)))
+                items.append(item)
+                raws.append(raw_codes.setdefault(row['answer'], len(raw_codes)))
+
+    table.workers = list(worker_codes)
+    table.items = list(item_codes)
+    table.worker = np.asarray(workers, dtype=np.int64)
+    table.item = np.asarray(items, dtype=np.int64)
+
+    # Normalize each distinct raw answer once, then map the rows through it
+    raw_to_answer = np.asarray([table.answer_code(normalize_answer(raw))
+                                for raw in raw_codes], dtype=np.int64)
+    table.answer = raw_to_answer[np.asarray(raws, dtype=np.int64)] if raws \
+        else np.zeros(0, dtype=np.int64)
+
+    table.truth = np.full(len(table.items), -1, dtype=np.int64)
+    for item, key in enumerate(table.items):
+        truth = truths.get(item)
+        if truth is None and ground_truth is not None:
+            try:
+                truth = ground_truth.get(*key)
+            except ValueError:
+                continue
+        if truth is not None:
+            table.truth[item] = table.answer_code(normalize_answer(truth))
+
+    logging.info(f"Loaded {len(table)} answers from {len(table.workers)} workers "
+                 f"on {len(table.items)} items")
+    return table
+
+
+def majority_answers(table: ResultTable) -> Dict[str, np.ndarray]:
+    """ Most frequent answer of each item, with its share of the answers """
+    if len(table) == 0:
+        return {'majority': np.full(len(table.items), -1, dtype=np.int64),
+                'agreement': np.zeros(len(table.items)),
+                'answers': np.zeros(len(table.items), dtype=np.int64)}
+
+    num_answers = max(len(table.answers), 1)
+    pairs, counts = np.unique(table.item * num_answers + table.answer, return_counts=True)
+    pair_item = pairs // num_answers
+
+    # Sort by item, then count, so the last pair of each item is its mode
+    order = np.lexsort((counts, pair_item))
+    last = np.r_[pair_item[order][1:] != pair_item[order][:-1], True]
+    modes = order[last]
+
+    total = np.bincount(table.item, minlength=len(table.items))
+    majority = np.full(len(table.items), -1, dtype=np.int64)
+    majority[pair_item[modes]] = pairs[modes] % num_answers
+    agreement = np.zeros(len(table.items))
+    agreement[pair_item[modes]] = counts[modes] / total[pair_item[modes]]
+    return {'majority': majority, 'agreement': agreement, 'answers': total}
+
+
+def worker_stats(table: ResultTable, majority: np.ndarray) -> Dict[str, np.ndarray]:
+    """ Per-worker answers, accuracy against ground truth and against the majority """
+    num_workers = len(table.workers)
+    truth = table.truth[table.item]
+    known = truth >= 0
+
+    answers = np.bincount(table.worker, minlength=num_workers)
+    graded = np.bincount(table.worker, weights=known, minlength=num_workers)
+    correct = np.bincount(table.worker, weights=known & (table.answer == truth),
+                          minlength=num_workers)
+    agree = np.bincount(table.worker, weights=table.answer == majority[table.item],
+                        minlength=num_workers)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        accuracy = np.where(graded > 0, correct / graded, np.nan)
+        agreement = agree / answers
+    return {'answers': answers, 'graded': graded.astype(np.int64),
+            'correct': correct.astype(np.int64),
+            'accuracy': accuracy, 'agreement': agreement}
+
+
+def answer_distribution(table: ResultTable, top: int = 20) -> List[Dict[str, Any]]:
+    counts = np.bincount(table.answer, minlength=len(table.answers))
+    order = np.argsort(-counts, kind='stable')[:top]
+    return [{'answer': table.answers[i], 'count': int(counts[i]),
+             'share': float(counts[i] / max(len(table), 1))}
+            for i in order if counts[i] > 0]
+
+
+def write_workers(filename: Union[Path, str], table: ResultTable,
+                  stats: Dict[str, np.ndarray], selected: np.ndarray) -> int:
+    """ A worker list, e.g. to block or to grant a qualification """
+    with open(filename, 'w', newline='') as fid:
+        writer = csv.writer(fid)
+        writer.writerow(['worker_id', 'answers', 'accuracy', 'agreement'])
+        for i in np.flatnonzero(selected):
+            writer.writerow([table.workers[i], int(stats['answers'][i]),
+                             round(float(stats['accuracy'][i]), 4),
+                             round(float(stats['agreement'][i]), 4)])
+    return int(selected.sum())
+
+
+def analyze(files: Iterable[Union[Path, str]],
+            ground_truth: Optional[Any] = None,
+            report: Optional[Union[Path, str]] = None,
+            block_list: Optional[Union[Path, str]] = None,
+            qualify_list: Optional[Union[Path, str]] = None,
+            block_below: float = 0.3,
+            qualify_above: float = 0.8,
+            min_answers: int = 10) -> Dict[str, Any]:
+    """
+    Worker accuracy, item agreement and answer distribution of result files.
+    A worker is scored on accuracy when ground truth is known, on agreement
+    with the majority otherwise, and listed only after `min_answers` answers.
+    """
+    table = load_results(files, ground_truth)
+    items = majority_answers(table)
+    stats = worker_stats(table, items['majority'])
+
+    score = np.where(np.isnan(stats['accuracy']), stats['agreement'], stats['accuracy'])
+    enough = stats['answers'] >= min_answers
+
+    summary = {
+        'answers': len(table),
+        'workers': len(table.workers),
+        'items': len(table.items),
+        'accuracy': float(stats['correct'].sum() / stats['graded'].sum())
+        if stats['graded'].sum() else None,
+        'item_agreement': float(items['agreement'].mean()) if len(table.items) else None,
+        'low_agreement_items': int((items['agreement'] < 0.5).sum()),
+    }
+    logging.info(f"Summary: {summary}")
+
+    if block_list is not None:
+        num_workers = write_workers(block_list, table, stats, enough & (score < block_below))
+        logging.info(f"{num_workers} workers to block written to {block_list}")
+    if qualify_list is not None:
+        num_workers = write_workers(qualify_list, table, stats, enough & (score >= qualify_above))
+        logging.info(f"{num_workers} workers to qualify written to {qualify_list}")
+
+    result = {'summary': summary,
+              'answers': answer_distribution(table),
+              'workers': [{'worker_id': worker,
+                           'answers': int(stats['answers'][i]),
+                           'accuracy': None if np.isnan(stats['accuracy'][i])
+                           else float(stats['accuracy'][i]),
+                           'agreement': float(stats['agreement'][i])}
+                          for i, worker in enumerate(table.workers)],
+              'items': [{'num_cubes': key[0], 'ref': key[1],
+                         'answers': int(items['answers'][i]),
+                         'agreement': float(items['agreement'][i]),
+                         'majority': table.answers[items['majority'][i]]}
+                        for i, key in enumerate(table.items)]}
+
+    if report is not None:
+        with open(report, 'w') as fid:
+            json.dump(result, fid, indent=2)
+        logging.info(f"Report written to {report}")
+    return result
@@ -0,0 +1,78 @@
+from typing import Any, Dict, List, Optional
+import json
+import xml.parsers.expat
+
+
+# Our HTML tasks post their results as JSON in a hidden field
+JSON_PREFIXES = ('{', '[')
+
+# The palette of the check template, in the order of its radio buttons
+COLORS = ["red", "orange", "yellow", "green", "blue", "grey", "black", "white", "pink"]
+
+
+def decode_value(value: str) -> Any:
+    """ Decode the JSON payload of a field, or return the text unchanged """
+    stripped = value.lstrip()
+    if stripped.startswith(JSON_PREFIXES):
+        try:
+            return json.loads(stripped)
+        except ValueError:
+            pass
+    return value
+
+
+def decode_colors(levels: List[int]) -> List[Optional[str]]:
+    """ Color names from bottom to top
+
+    The check template lists the radio groups of the levels from the top,
+    with -1 for a level left blank.
+    """
+    return [COLORS[i] if 0 <= i < len(COLORS) else None for i in reversed(levels)]
+
+
+def parse_answers(answer: str, decode_json: bool = True) -> Dict[str, Any]:
+    """ Parse a QuestionFormAnswers document into {identifier: value}
+
+    The XML is streamed through expat without building a tree. Fields with
+    several SelectionIdentifier elements are returned as lists.
+    """
+    record: Dict[str, Any] = {}
+    text: List[str] = []
+    field: Dict[str, Any] = {}
+
+    def start(name: str, attrs: Dict[str, str]) -> None:
+        text.clear()
+        if name.endswith('Answer'):
+            field.clear()
+
+    def data(chunk: str) -> None:
+        text.append(chunk)
+
+    def end(name: str) -> None:
+        # Strip the namespace, if expat was asked to report it
+        name = name.rpartition(' ')[2]
+        if name == 'QuestionIdentifier':
+            field['id'] = ''.join(text)
+        elif name == 'SelectionIdentifier':
+            field.setdefault('selections', []).append(''.join(text))
+        elif name in ('FreeText', 'OtherSelectionText', 'UploadedFileKey'):
+            field['value'] = ''.join(text)
+        elif name == 'Answer' and 'id' in field:
+            if 'value' in field:
+                value = field['value']
+                record[field['id']] = decode_value(value) if decode_json else value
+            elif 'selections' in field:
+                selections = field['selections']
+                record[field['id']] = selections[0] if len(selections) == 1 \
+                    else selections
+            else:
+                record[field['id']] = ''
+        text.clear()
+
+    parser = xml.parsers.expat.ParserCreate(namespace_separator=' ')
+    parser.buffer_text = True
+    parser.StartElementHandler = start
+    parser.CharacterDataHandler = data
+    parser.EndElementHandler = end
+    parser.Parse(answer, True)
+    return record
@@ -1,31 +1,55 @@
 import logging
-import yaml
-from typing import Dict, Any, List
+import json
+import os
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Callable, Dict, Any, List, Optional, Tuple
 import boto3
-from datetime import datetime
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
 from tqdm.auto import tqdm
 from config import get_config
+from clients import get_client
+from records import get_journal
+from inventory import get_inventory, iter_hits
+from lifecycle import process_hits
+from throttle import TokenBucket, call_with_backoff
 
 
-def connect_mturk() -> boto3.session.Session:
-    aws: Dict[str, Any] = get_config('aws')
-    mturk: Dict[str, Any] = get_config('mturk')
+# A HIT in one of these states won't get new assignments
+TERMINAL_STATUSES = {'Reviewable', 'Reviewing', 'Disposed'}
 
-    client = boto3.client('mturk',
-                          aws_access_key_id=aws['access_key_id'],
-                          aws_secret_access_key=aws['secret_access_key'],
-                          region_name=aws['region_name'],
-                          endpoint_url=mturk['endpoint_url'])
+
+def connect_mturk(check_balance: bool = False) -> boto3.session.Session:
+    """ The shared MTurk client of the process """
+    client = get_client('mturk')
 
     logging.info("Successfully connected to the MTurk account")
 
-    balance = client.get_account_balance()['AvailableBalance']
-    logging.debug(f"I have ${balance} in my account")
+    if check_balance:
+        balance = call_with_backoff(client.get_account_balance)['AvailableBalance']
+        logging.info(f"I have ${balance} in my account")
 
     return client
 
 
+class LazyClient:
+    """ Stand-in for a boto3 client, built on the first attribute access """
+
+    def __init__(self, factory: Callable[[], Any]):
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name: str) -> Any:
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory()
+        return getattr(self._client, name)
+
+
 def list_bucket_objects(client, bucket_name: str) -> List:
     """List the objects in an Amazon S3 bucket
 
@@ -33,17 +57,20 @@ def list_bucket_objects(client, bucket_name: str) -> List:
     :return: List of bucket objects. If error, return None.
     """
 
-    # Retrieve the list of bucket objects
+    # Retrieve the list of bucket objects, following the continuation tokens
+    contents = []
     try:
-        response = client.list_objects_v2(Bucket=bucket_name)
+        paginator = client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name):
+            contents += page.get('Contents', [])
     except ClientError as err:
         # AllAccessDisabled error == bucket not found
         logging.error(err)
         return None
 
     # Only return the contents if we found some keys
-    if response['KeyCount'] > 0:
-        return response['Contents']
+    if contents:
+        return contents
 
     return None
 
@@ -52,66 +79,49 @@ def list_all_hits(client: boto3.session.Session):
     """
     Return all HITs connected to current account
     """
-    hits = []
-    response = client.list_hits()
-
-    while 'NextToken' in response and response['NextToken'] != "":
-        response = client.list_hits(NextToken=response['NextToken'])
-        hits += response['HITs']
-
-    return hits
+    return list(iter_hits(client))
 
 
 def list_recorded_hits(client: boto3.session.Session):
     """
-    Return all HITs stored in job.yaml
+    Return all HITs stored in the job journal
     """
     config = get_config()
-
-    with open(config['job_filename'], "r") as fid:
-        hits = yaml.safe_load(fid)
-
-    return hits
+    return list(get_journal(config['job_filename']))
 
 
 
 def delete_hit(client: boto3.session.Session, hit_id: str):
-    try:
-        # If HIT is active then set it to expire immediately
-        status = client.get_hit(HITId=hit_id)['HIT']['HITStatus']
-        if status == 'Assignable':
-            response = client.update_expiration_for_hit(
-                HITId=hit_id,
-                ExpireAt=datetime(2015, 1, 1)
-            )
-        client.delete_hit(HITId=hit_id)
+    """ Expire the HIT and delete it if it is already reviewable """
+    process_hits(client, [hit_id], workers=1)
 
-    except:
-        logging.error(f"Can't delete {hit_id}")
 
-
-def delete_recorded_hits(client: boto3.session.Session):
+def delete_recorded_hits(client: boto3.session.Session,
+                         expire_only: bool = False,
+                         workers: int = 16):
     """
-    Delete all HITs present in job.yaml
+    Delete all HITs present in the job journal
     """
     records = list_recorded_hits(client)
+    process_hits(client, [record['HITId'] for record in records],
+                 delete=not expire_only, workers=workers)
 
-    for record in tqdm(records):
-        delete_hit(client, record['HITId'])
-
-def delete_all_hits(client: boto3.session.Session):
 
-    records = list_all_hits(client)
+def delete_all_hits(client: boto3.session.Session,
+                    expire_only: bool = False,
+                    workers: int = 16):
 
-    for record in tqdm(records):
-        delete_hit(client, record['HITId'])
+    inventory = get_inventory()
+    inventory.sync(client)
+    process_hits(client, inventory.hit_ids(),
+                 delete=not expire_only, workers=workers)
 
 
-def get_hit_progress(client: boto3.session.Session, hit_id: str
-                    ) -> List[int]:
+def get_hit_status(client: boto3.session.Session, hit_id: str
+                   ) -> Tuple[int, int, str]:
     """
-    Return the number of completed assignements wrt.
-    total number of assignements
+    Return the number of completed assignements, the total number
+    of assignements and the HIT status
     """
     hit = client.get_hit(HITId=hit_id)['HIT']
     total = int(hit['MaxAssignments'])
@@ -121,6 +131,16 @@ def get_hit_progress(client: boto3.session.Session, hit_id: str
         for a in a_page['Assignments']:
             if a['AssignmentStatus'] in ['Submitted', 'Approved', 'Rejected']:
                 completed += 1
+    return completed, total, hit['HITStatus']
+
+
+def get_hit_progress(client: boto3.session.Session, hit_id: str
+                    ) -> Tuple[int, int]:
+    """
+    Return the number of completed assignements wrt.
+    total number of assignements
+    """
+    completed, total, _ = get_hit_status(client, hit_id)
     return completed, total
 
 
@@ -130,43 +150,120 @@ def is_hit_completed(client: boto3.session.Session, hit_id: str) -> bool:
     return completed == total
 
 
-def progress_hits(client: boto3.session.Session, hits: List[str]) -> None:
+def load_progress_cache() -> Dict[str, List[int]]:
+    """ HITs already in a terminal state, with their final progress """
+    cache_file = Path(get_config().get('progress_cache', 'progress_cache.json'))
+    if not cache_file.is_file():
+        return {}
+    with open(cache_file, 'r') as fid:
+        return json.load(fid)
+
+
+def save_progress_cache(cache: Dict[str, List[int]]) -> None:
+    cache_file = Path(get_config().get('progress_cache', 'progress_cache.json'))
+    tmp_file = cache_file.with_name(cache_file.name + '.tmp')
+    with open(tmp_file, 'w') as fid:
+        json.dump(cache, fid)
+    os.replace(tmp_file, cache_file)
 
-    all_completed, all_total = 0, 0
 
-    for hit in hits:
-        completed, total = get_hit_progress(client, hit)
-        all_completed += completed
-        all_total += total
-        logging.info(f"{hit}: {completed}/{total}")
-        pbar = tqdm(total=total)
-        pbar.update(completed)
+def progress_hits(client: boto3.session.Session,
+                  hits: List[str],
+                  task_names: Optional[Dict[str, str]] = None,
+                  workers: int = 16,
+                  rate: float = 10.) -> Tuple[int, int]:
+    """
+    Show the aggregated progress of the HITs, with a breakdown per task.
+    Only HITs that are not known to be terminal are queried.
+    """
+    task_names = task_names or {}
+    cache = load_progress_cache()
+    progress: Dict[str, List[int]] = {h: cache[h] for h in hits if h in cache}
+    live = [h for h in hits if h not in cache]
+    logging.info(f"{len(progress)} HITs are terminal, querying {len(live)} HITs")
+
+    bucket = TokenBucket(rate, burst=workers)
+    pbar = tqdm(total=len(hits), initial=len(progress), unit='HIT')
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(call_with_backoff, get_hit_status,
+                                       client, hit, bucket=bucket): hit
+                       for hit in live}
+            for future in as_completed(futures):
+                hit = futures[future]
+                try:
+                    completed, total, status = future.result()
+                except (ClientError, BotoCoreError) as err:
+                    logging.error(f"Can't get the progress of {hit}: {err}")
+                else:
+                    progress[hit] = [completed, total]
+                    if completed == total or status in TERMINAL_STATUSES:
+                        cache[hit] = [completed, total]
+                pbar.update(1)
+    finally:
+        # Keep the terminal HITs found so far, even if the run is interrupted
         pbar.close()
+        save_progress_cache(cache)
 
-def progress_recorded_hits(client: boto3.session.Session):
+    per_task: Dict[str, List[int]] = defaultdict(lambda: [0, 0, 0, 0])
+    for hit, (completed, total) in progress.items():
+        counts = per_task[task_names.get(hit, 'unknown')]
+        counts[0] += completed
+        counts[1] += total
+        counts[2] += int(completed == total)
+        counts[3] += 1
+
+    for task_name, (completed, total, done, num_hits) in sorted(per_task.items()):
+        logging.info(f"{task_name}: {completed}/{total} assignments, "
+                     f"{done}/{num_hits} HITs completed")
+
+    all_completed = sum(c for c, _ in progress.values())
+    all_total = sum(t for _, t in progress.values())
+    logging.info(f"Total: {all_completed}/{all_total} assignments")
+    return all_completed, all_total
+
+
+def progress_recorded_hits(client: boto3.session.Session, workers: int = 16):
     """
     Return progress on the execution of the HITs
     """
     logging.info('Retrieve all HITs')
     hits = list_recorded_hits(client)
-    progress_hits(client, [i['HITId'] for i in hits])
+    progress_hits(client, [i['HITId'] for i in hits],
+                  task_names={i['HITId']: i.get('task_name') for i in hits},
+                  workers=workers)
+
 
-def progress_all_hits(client: boto3.session.Session):
+def progress_all_hits(client: boto3.session.Session, sync: bool = True):
     """
-    Return progress on the execution of the HITs
+    Return progress on the execution of the HITs, from the local inventory
     """
-    logging.info('Retrieve all HITs')
-    hits = list_all_hits(client)
-    progress_hits(client, [i['HITId'] for i in hits])
+    inventory = get_inventory()
+    if sync:
+        logging.info('Sync the HIT inventory')
+        inventory.sync(client)
+
+    progress = inventory.progress()
+    for status, num_hits in sorted(inventory.count_by_status().items()):
+        logging.info(f"{status}: {num_hits} HITs")
+
+    all_completed = sum(c for c, _ in progress.values())
+    all_total = sum(t for _, t in progress.values())
+    logging.info(f"Total: {all_completed}/{all_total} assignments")
+    return all_completed, all_total
 
 
 def send_bonus(client: boto3.session.Session,
                assignement: str,
                worker: str,
                amount: str,
-               message: str):
+               message: str,
+               token: Optional[str] = None):
 
+    kwargs = {} if token is None else {'UniqueRequestToken': token}
     client.send_bonus(WorkerId=str(worker),
                       BonusAmount=str(amount),
                       AssignmentId=str(assignement),
-                      Reason=message)
+                      Reason=message,
+                      **kwargs)
@@ -0,0 +1,57 @@
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Union
+from itertools import islice
+from pathlib import Path
+import csv
+import json
+
+
+def chunked(iterable: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    """ Group an iterable into lists of `size` items. The last one may be shorter """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def write_groups(samples: Iterable[Dict[str, Any]],
+                 output: Union[Path, str],
+                 group_size: int = 3,
+                 fmt: Optional[str] = None,
+                 drop_partial: bool = False) -> int:
+    """ Stream samples into a file, `group_size` samples per line
+
+    JSONL lines hold a list of samples. CSV rows flatten a group into
+    key0, key1, ... columns, and a trailing partial group leaves the
+    missing columns empty. The format defaults to the file extension.
+    Return the number of written groups.
+    """
+    output = Path(output)
+    if fmt is None:
+        fmt = 'csv' if output.suffix == '.csv' else 'jsonl'
+    if fmt not in ('csv', 'jsonl'):
+        raise ValueError(f"Unknown format {fmt}")
+
+    num_groups = 0
+    with open(output, "w", newline='') as fid:
+        writer = None
+        for group in chunked(samples, group_size):
+            if drop_partial and len(group) < group_size:
+                break
+
+            if fmt == 'jsonl':
+                fid.write(json.dumps(group))
+                fid.write('\n')
+            else:
+                if writer is None:
+                    fieldnames = [f"{key}{i}" for i in range(group_size)
+                                  for key in group[0]]
+                    writer = csv.DictWriter(fid, fieldnames=fieldnames)
+                    writer.writeheader()
+                writer.writerow({f"{key}{i}": value
+                                 for i, sample in enumerate(group)
+                                 for key, value in sample.items()})
+            num_groups += 1
+
+    return num_groups
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+""" Compare the QuestionFormAnswers parsers on synthetic assignments
+
+    python benchmarks/bench_answers.py --num 100000
+"""
+from pathlib import Path
+import argparse
+import json
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from answers import parse_answers
+
+
+ANSWER = """<?xml version="1.0" encoding="ASCII"?>
+<QuestionFormAnswers xmlns="http://mechanicalturk.amazonaws.com/AWSMechanicalTurkDataSchemas/2005-10-01/QuestionFormAnswers.xsd">
+<Answer><QuestionIdentifier>assignmentId</QuestionIdentifier><FreeText>{assignment}</FreeText></Answer>
+<Answer><QuestionIdentifier>output</QuestionIdentifier><FreeText>{output}</FreeText></Answer>
+</QuestionFormAnswers>"""
+
+
+def make_answers(num: int):
+    output = json.dumps([{'stepByStep': 'Put the red cube on the blue cube. ' * 4}] * 3)
+    output = output.replace('&', '&amp;').replace('<', '&lt;').replace('"', '&quot;')
+    return [ANSWER.format(assignment=f"A{i:012d}", output=output) for i in range(num)]
+
+
+def parse_xmltodict(answer: str):
+    """ The parser used before, as in retrieve.retrieve_job """
+    import xmltodict
+    fields = xmltodict.parse(answer)['QuestionFormAnswers']['Answer']
+    if not isinstance(fields, list):
+        fields = [fields]
+    return {f['QuestionIdentifier']: f['FreeText'] for f in fields}
+
+
+def bench(name: str, func, answers) -> float:
+    start = time.perf_counter()
+    for answer in answers:
+        func(answer)
+    elapsed = time.perf_counter() - start
+    print(f"{name:>20}: {elapsed:.3f}s, {len(answers) / elapsed:,.0f} assignments/s")
+    return elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num", default=20000, type=int)
+    args = parser.parse_args()
+
+    answers = make_answers(args.num)
+    fast = bench("expat", parse_answers, answers)
+    bench("expat (no json)", lambda a: parse_answers(a, decode_json=False), answers)
+
+    try:
+        slow = bench("xmltodict", parse_xmltodict, answers)
+        print(f"Speed-up: {slow / fast:.1f}x")
+    except ImportError:
+        print("xmltodict is not installed, skipping the baseline")
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+""" End-to-end throughput of the MTurk pipeline against an in-process fake
+
+    python benchmarks/bench_mturk.py --sizes 1000,10000,100000 --latency 0.02
+
+The fake from fake_mturk.py is registered as the 'mturk' client, so the real
+cli.py submit command and the aws, lifecycle, harvest and bonus code run
+unchanged. Each size runs in a fresh folder with its own config, journals
+and inventory. Stages: submit, progress, inventory sync, harvest, bonus and
+delete. Workers submit assignments before progress, and the fake approves
+them before delete.
+"""
+from collections import Counter
+from pathlib import Path
+import argparse
+import csv
+import logging
+import os
+import sys
+import tempfile
+import time
+
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+CONFIG = """
+job_filename: jobs.jsonl
+template_folder: {root}/templates
+mturk:
+  endpoint_url: https://fake-mturk.local
+  preview_url: 'https://fake-mturk.local/preview?groupId='
+tasks:
+  - name: stepbystep
+    template: write-instructions.html
+    title: Benchmark
+    description: Benchmark
+    keywords: benchmark
+    reward: 0.15
+    max_assignments: {assignments}
+    lifetime: 172800
+    assignment_duration: 600
+    auto_approval_delay: 14400
+"""
+
+
+def reset_state() -> None:
+    """ Forget the journals, inventory and registry of the previous size """
+    import config
+    import hittypes
+    import inventory
+    import records
+    import submit
+
+    records._journals.clear()
+    inventory._inventory = None
+    hittypes._registry = None
+    submit._templates.clear()
+    config.reload_config()
+
+
+def write_samples(filename: Path, size: int) -> None:
+    with open(filename, 'w', newline='') as fid:
+        writer = csv.writer(fid, delimiter=';')
+        writer.writerow(['before', 'after', 'id'])
+        for i in range(size):
+            writer.writerow([f"{i}_first.jpg", f"{i}_last.jpg", str(i)])
+
+
+class Stages:
+    """ Wall time, items and fake MTurk calls of each stage """
+
+    def __init__(self, client):
+        self.client = client
+        self.rows = []
+
+    def run(self, name: str, num_items: int, func, *args, **kwargs):
+        calls = Counter(self.client.calls)
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        calls = Counter(self.client.calls) - calls
+        self.rows.append((name, elapsed, num_items, sum(calls.values())))
+        return result
+
+    def report(self, size: int) -> None:
+        total = sum(row[1] for row in self.rows)
+        print(f"\n{size} HITs, {total:.2f} s in total")
+        print(f"{'stage':>10} {'seconds':>9} {'items':>8} {'items/s':>10} {'calls':>8}")
+        for name, elapsed, num_items, num_calls in self.rows:
+            print(f"{name:>10} {elapsed:9.2f} {num_items:8d} "
+                  f"{num_items / elapsed if elapsed else 0:10.0f} {num_calls:8d}")
+
+
+def run(size: int, args: argparse.Namespace) -> None:
+    import aws
+    import cli
+    import clients
+    from bonus import pay_bonuses
+    from fake_mturk import FakeMTurk
+    from harvest import harvest
+    from inventory import get_inventory
+    from lifecycle import process_hits
+    import submit  # noqa: F401
+
+    # cli.py and submit.py set the root logger to INFO when imported
+    logging.getLogger().setLevel(logging.WARNING)
+    client = FakeMTurk(latency=args.latency, throttle_rate=args.throttle_rate,
+                       failure_rate=args.failure_rate, seed=args.seed)
+    clients.register_client('mturk', lambda: client)
+    stages = Stages(client)
+
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        Path('config').mkdir()
+        with open('config/0.bench.yaml', 'w') as fid:
+            fid.write(CONFIG.format(root=ROOT, assignments=args.assignments))
+        write_samples(Path('samples.csv'), size)
+        reset_state()
+
+        stages.run('submit', size, cli.cli.main,
+                   ['submit', '--all-tasks', '--from-csv', 'samples.csv',
+                    '--workers', str(args.workers), '--rate', str(args.rate)],
+                   standalone_mode=False)
+        hit_ids = [job['HITId'] for job in aws.list_recorded_hits(client)]
+
+        num_assignments = client.simulate_work(args.fraction)
+        stages.run('progress', len(hit_ids), aws.progress_hits, client, hit_ids,
+                   workers=args.workers, rate=args.rate)
+        stages.run('inventory', len(hit_ids), get_inventory().sync, client)
+        jobs = aws.list_recorded_hits(client)
+        stages.run('harvest', len(jobs), harvest, client, jobs, 'results.csv',
+                   workers=args.workers, rate=args.rate)
+        stages.run('bonus', num_assignments, pay_bonuses, client, 'results.csv',
+                   'bonus.csv', 0.01, 'Thanks', workers=args.workers, rate=args.rate)
+
+        client.review_all()
+        counts = stages.run('delete', len(hit_ids), process_hits, client, hit_ids,
+                            workers=args.workers, rate=args.rate)
+        os.chdir(ROOT)
+
+    stages.report(size)
+    print(f"{'':>10} delete: {counts}; fake calls: {dict(client.calls)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    parser.add_argument("--latency", default=0., type=float,
+                        help="Seconds added to every fake MTurk call")
+    parser.add_argument("--throttle-rate", default=0., type=float,
+                        help="Probability that a call is throttled")
+    parser.add_argument("--failure-rate", default=0., type=float,
+                        help="Probability that a call fails with a ServiceFault")
+    parser.add_argument("--fraction", default=0.5, type=float,
+                        help="Fraction of the assignments submitted by workers")
+    parser.add_argument("--assignments", default=3, type=int,
+                        help="MaxAssignments of each HIT")
+    parser.add_argument("--workers", default=16, type=int)
+    parser.add_argument("--rate", default=0., type=float,
+                        help="Client-side rate limit; 0 disables it")
+    parser.add_argument("--seed", default=0, type=int)
+    args = parser.parse_args()
+
+    for size in [int(s) for s in args.sizes.split(",")]:
+        run(size, args)
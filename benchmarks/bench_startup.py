@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+""" Startup time of every cli.py command, and heavy modules it imports
+
+    python benchmarks/bench_startup.py --repeat 5 --max-ms 300
+
+Each command is started with --help in a fresh interpreter, so only the
+startup path is measured. The script fails if a command goes over
+--max-ms (import and parse time) or imports one of HEAVY_MODULES.
+
+Then the modules imported by the body of each command, read from cli.py,
+are imported in a fresh interpreter: that is the import cost of actually
+running the command. The script fails if an offline command pulls in
+boto3 or botocore this way.
+"""
+from pathlib import Path
+import argparse
+import ast
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+HEAVY_MODULES = ['boto3', 'botocore', 'jinja2', 'tqdm', 'numpy', 'xmltodict']
+
+# Commands that never talk to AWS, so their bodies must not load its SDK
+OFFLINE_COMMANDS = {'analyze', 'check-generator', 'ground-truth'}
+AWS_MODULES = ['boto3', 'botocore']
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import cli
+try:
+    cli.cli.main(sys.argv[1:], standalone_mode=False)
+except SystemExit:
+    pass
+elapsed = time.perf_counter() - start
+heavy = [m for m in {heavy} if m in sys.modules]
+print(json.dumps({{'seconds': elapsed, 'heavy': heavy}}))
+"""
+
+BODY_PROBE = """
+import importlib, json, sys, time
+import cli
+start = time.perf_counter()
+for name in sys.argv[1:]:
+    importlib.import_module(name)
+elapsed = time.perf_counter() - start
+heavy = [m for m in {heavy} if m in sys.modules]
+print(json.dumps({{'seconds': elapsed, 'heavy': heavy}}))
+"""
+
+
+def list_commands():
+    sys.path.insert(0, str(ROOT))
+    import cli
+    return sorted(cli.cli.commands)
+
+
+def _imports(node: ast.AST) -> set:
+    modules = set()
+    for child in ast.walk(node):
+        if isinstance(child, ast.Import):
+            modules.update(alias.name for alias in child.names)
+        elif isinstance(child, ast.ImportFrom) and child.module:
+            modules.add(child.module)
+    return modules
+
+
+def body_modules() -> dict:
+    """ Modules imported by each command body of cli.py, including the
+    imports of the cli.py helpers it calls, e.g. mturk_client """
+    tree = ast.parse((ROOT / "cli.py").read_text())
+    functions = {node.name: node for node in tree.body
+                 if isinstance(node, ast.FunctionDef)}
+    modules = {}
+    for node in functions.values():
+        names = [decorator.args[0].value for decorator in node.decorator_list
+                 if isinstance(decorator, ast.Call)
+                 and getattr(decorator.func, 'attr', None) == 'command'
+                 and decorator.args]
+        if not names:
+            continue
+        imported = _imports(node)
+        for call in ast.walk(node):
+            if isinstance(call, ast.Call) and isinstance(call.func, ast.Name) \
+                    and call.func.id in functions:
+                imported |= _imports(functions[call.func.id])
+        modules[names[0]] = sorted(imported)
+    return modules
+
+
+def run_probe(probe: str, arguments: list) -> dict:
+    output = subprocess.run([sys.executable, "-c", probe, *arguments],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def measure_body(modules: list, repeat: int):
+    """ Median import time of the modules of a command body, and heavy imports """
+    probe = BODY_PROBE.format(heavy=HEAVY_MODULES)
+    inner, heavy = [], []
+    for _ in range(repeat):
+        result = run_probe(probe, modules)
+        inner.append(result['seconds'])
+        heavy = result['heavy']
+    return statistics.median(inner), heavy
+
+
+def measure(command: str, repeat: int):
+    """ Median process time, median import + parse time, and heavy imports """
+    probe = PROBE.format(heavy=HEAVY_MODULES)
+    process, inner, heavy = [], [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = run_probe(probe, [command, "--help"])
+        process.append(time.perf_counter() - start)
+        inner.append(result['seconds'])
+        heavy = result['heavy']
+    return statistics.median(process), statistics.median(inner), heavy
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", default=5, type=int)
+    parser.add_argument("--max-ms", default=None, type=float)
+    args = parser.parse_args()
+
+    failed = False
+    for command in list_commands():
+        process, seconds, heavy = measure(command, args.repeat)
+        flags = []
+        if heavy:
+            flags.append(f"imports {', '.join(heavy)}")
+        if args.max_ms is not None and seconds * 1000 > args.max_ms:
+            flags.append(f"over {args.max_ms:.0f} ms")
+        failed = failed or bool(flags)
+        print(f"{command:>16}: {seconds * 1000:7.1f} ms in cli, "
+              f"{process * 1000:7.1f} ms process  {'; '.join(flags)}")
+
+    print()
+    for command, modules in sorted(body_modules().items()):
+        seconds, heavy = measure_body(modules, args.repeat)
+        aws = [module for module in AWS_MODULES if module in heavy]
+        flag = ""
+        if command in OFFLINE_COMMANDS and aws:
+            flag = f"offline command imports {', '.join(aws)}"
+            failed = True
+        print(f"{command:>16}: {seconds * 1000:7.1f} ms to import {', '.join(modules)}"
+              f"{' (' + ', '.join(heavy) + ')' if heavy else ''}  {flag}")
+
+    sys.exit(1 if failed else 0)
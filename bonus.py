@@ -0,0 +1,138 @@
+from typing import Any, Dict, Iterator, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import Counter
+from pathlib import Path
+import csv
+import logging
+import os
+import threading
+from botocore.exceptions import ClientError
+from tqdm.auto import tqdm
+from aws import send_bonus
+from throttle import TokenBucket, call_with_backoff
+
+
+PENDING = 'pending'
+PAID = 'paid'
+FAILED = 'failed'
+
+
+def bonus_token(assignment: str) -> str:
+    """ MTurk ignores a second bonus with the same token (for 24 hours) """
+    return f"bonus-{assignment}"[:64]
+
+
+def is_duplicate_token(err: ClientError) -> bool:
+    message = str(err).lower()
+    return 'token' in message and 'already' in message
+
+
+class BonusLedger:
+    """ Write-ahead ledger of bonus payments
+
+    Rows are (assignment, worker, amount, message, status). A row is written
+    and fsynced as pending before the payment and as paid after it. Rows
+    from older ledgers have no status and count as paid.
+    """
+
+    def __init__(self, filename: Union[Path, str]):
+        self.filename = Path(filename)
+        self.status: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+        if self.filename.is_file():
+            with open(self.filename, 'r', newline='') as fid:
+                for row in csv.reader(fid, delimiter=','):
+                    if row:
+                        self.status[row[0]] = row[4] if len(row) > 4 else PAID
+
+    def is_paid(self, assignment: str) -> bool:
+        return self.status.get(assignment) == PAID
+
+    def write(self, assignment: str, worker: str, amount: float,
+              message: str, status: str) -> None:
+        with self._lock:
+            with open(self.filename, 'a', newline='') as fid:
+                writer = csv.writer(fid, delimiter=',')
+                writer.writerow([assignment, worker, amount, message, status])
+                fid.flush()
+                os.fsync(fid.fileno())
+            self.status[assignment] = status
+
+
+def read_assignments(from_csv: Union[Path, str]) -> Iterator[Tuple[str, str]]:
+    """ Stream the unique (assignment, worker) pairs of a result file """
+    seen = set()
+    with open(from_csv, 'r', newline='') as fid:
+        for row in csv.DictReader(fid, delimiter=','):
+            assignment = row['assignment_id']
+            if assignment not in seen:
+                seen.add(assignment)
+                yield assignment, row['worker_id']
+
+
+def pay_bonuses(client: Any,
+                from_csv: Union[Path, str],
+                ledger_file: Union[Path, str],
+                amount: float,
+                message: str,
+                workers: int = 8,
+                rate: float = 5.) -> Dict[str, int]:
+    """ Pay a bonus for every assignment of the result file exactly once
+
+    Each payment carries a UniqueRequestToken derived from the assignment,
+    and a payment tried by a previous run is only sent again if
+    list_bonus_payments has none for the assignment. A payment whose
+    outcome is unknown stays pending.
+    """
+    ledger = BonusLedger(ledger_file)
+    bucket = TokenBucket(rate, burst=workers)
+    todo = [(assignment, worker)
+            for assignment, worker in read_assignments(from_csv)
+            if not ledger.is_paid(assignment)]
+    logging.info(f"{len(todo)} bonuses to pay")
+
+    def already_paid(assignment: str) -> bool:
+        """ Whether MTurk has a payment for the assignment """
+        response = call_with_backoff(client.list_bonus_payments,
+                                     AssignmentId=assignment, bucket=bucket)
+        return len(response['BonusPayments']) > 0
+
+    def pay(assignment: str, worker: str) -> str:
+        # The token only protects a retry for 24 hours, so a payment tried
+        # by a previous run is looked up before being sent again
+        if assignment in ledger.status:
+            try:
+                if already_paid(assignment):
+                    ledger.write(assignment, worker, amount, message, PAID)
+                    return PAID
+            except Exception as err:
+                logging.error(f"Can't check the bonus of {assignment}, left as is: {err}")
+                return ledger.status[assignment]
+
+        try:
+            ledger.write(assignment, worker, amount, message, PENDING)
+            call_with_backoff(send_bonus, client, assignment, worker,
+                              amount, message, bonus_token(assignment),
+                              bucket=bucket)
+        except ClientError as err:
+            if not is_duplicate_token(err):
+                logging.error(f"Can't pay {worker} for {assignment}: {err}")
+                ledger.write(assignment, worker, amount, message, FAILED)
+                return FAILED
+        except Exception as err:
+            # The payment may or may not have gone through: keep it pending
+            logging.error(f"Can't pay {worker} for {assignment}, left pending: {err}")
+            return PENDING
+        ledger.write(assignment, worker, amount, message, PAID)
+        return PAID
+
+    counts: Counter = Counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(pay, assignment, worker)
+                   for assignment, worker in todo]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            counts[future.result()] += 1
+
+    logging.info(f"Bonuses: {dict(counts)}")
+    return dict(counts)
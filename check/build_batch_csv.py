@@ -1,74 +1,169 @@
 from tempfile import TemporaryDirectory
 from dataclasses import dataclass, asdict
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Tuple
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 from pathlib import Path
 from tqdm import tqdm
 import argparse
-import csv
+import os
+import sys
+import numpy as np
 from PIL import Image
 import pymongo
-import boto3
-from botocore.exceptions import ClientError
+from bson import json_util
 from dacite import from_dict
 import nalanbot as nb
 from utils import *
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from batch import chunked, write_groups
+from upload import upload_files
+
 
 @dataclass
 class Sample:
     sentence: str
-    state: nb.State
-    _id: str
+    raw_state: Dict[str, Any]
+    _id: Any
     url: str = ""
 
+    @property
+    def state(self) -> nb.State:
+        """ The State is only built when the sample is rendered """
+        return from_dict(nb.State, self.raw_state)
+
+
+def load_samples(host: str, collection: str,
+                 batch_size: int = 1000,
+                 after: Optional[Any] = None,
+                 client: Optional[Any] = None) -> Iterator[Sample]:
+    """ Stream the samples of a collection in _id order
+
+    Only the sentence and the first state are fetched. With `after`, only
+    documents whose _id is greater are returned.
+    """
+    if client is None:
+        client = pymongo.MongoClient(host=host)
+    col = client.nalanbot[collection]
+    query = {} if after is None else {"_id": {"$gt": after}}
+    projection = {"sentence": 1, "states": {"$slice": 1}}
+    cursor = col.find(query, projection, batch_size=batch_size).sort("_id", 1)
+    for ds in cursor:
+        yield Sample(ds["sentence"], ds["states"][0], ds["_id"])
+
+
+def read_last_exported(build: Path, collection: str) -> Optional[Any]:
+    """ The greatest _id exported by a previous build """
+    marker = build / f"exported-{collection}.json"
+    if not marker.is_file():
+        return None
+    with open(marker, "r") as fid:
+        return json_util.loads(fid.read())["_id"]
+
+
+def write_last_exported(build: Path, collection: str, last_id: Any) -> None:
+    marker = build / f"exported-{collection}.json"
+    tmp_file = marker.with_name(marker.name + ".tmp")
+    with open(tmp_file, "w") as fid:
+        fid.write(json_util.dumps({"_id": last_id}))
+    os.replace(tmp_file, marker)
+
+
+def encode_png(shm_name: str, shape: Tuple[int, ...], dtype: str,
+               output_file: Path) -> None:
+    """ Runs in a worker process: save an RGB buffer from shared memory """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        rgb = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        Image.fromarray(rgb).save(output_file)
+    finally:
+        shm.close()
+
+
+def to_shared_memory(array: np.ndarray) -> shared_memory.SharedMemory:
+    shm = shared_memory.SharedMemory(create=True, size=array.nbytes)
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+    return shm
+
+
+def render_samples(samples: Iterable[Sample], bucket_name: str,
+                   upload: bool = True, workers: int = 16,
+                   chunk_size: int = 32, encoders: Optional[int] = None
+                   ) -> Iterator[Sample]:
+    """ Render, encode and upload the samples in a bounded pipeline
+
+    States are rendered chunk by chunk and depth buffers are dropped right
+    away. RGB buffers are handed to a pool of PNG encoders through shared
+    memory, with at most 2 * encoders images in flight. Each sample is
+    yielded, without its raw state, once its image is encoded; the images
+    are uploaded when the samples are exhausted.
+    """
+    encoders = encoders or os.cpu_count() or 1
+    max_pending = 2 * encoders
 
-def load_samples(host: str, collection: str) -> List[Sample]:
-    client = pymongo.MongoClient(host=args.host)
-    col = client.nalanbot[args.collection]
-    return [
-        Sample(ds["sentence"], from_dict(nb.State, ds["states"][0]), ds["_id"])
-        for ds in col.find()
-    ]
-
-
-def render_samples(samples: List[Sample], bucket_name: str) -> None:
-    s3 = boto3.client("s3")
     with TemporaryDirectory() as tmpdir:
         tmppath = Path(tmpdir)
         manager = nb.ExperimentManager(output_folder=tmppath)
         nb.supervised_default_params(manager)
         render = nb.render_init(manager)
-        images = render([s.state for s in samples])
-
-        for image, sample in zip(tqdm(images), samples):
-            rgb, depth = image
-            local_file = f"{sample._id}.png"
-            Image.fromarray(rgb).save(tmppath / local_file)
-            sample.url = f"https://{bucket_name}.s3.amazonaws.com/{local_file}"
-            # s3.upload_file(str(tmppath / local_file), bucket_name, local_file)
-
 
-def export_csv(filename: Path, samples: List[Sample]) -> None:
-    rows = []
-    num_samples = len(samples)
-    index = list(range(num_samples))
-    for subindex in index[::3]:
-        row = {}
-        max_index = min(len(index), subindex + 3)
-        for i, sample_id in enumerate(range(subindex, max_index)):
-            row[f"sentence{i}"] = samples[sample_id].sentence
-            row[f"id{i}"] = samples[sample_id]._id
-            row[f"url{i}"] = samples[sample_id].url
-        rows.append(row)
+        files = []
+        pending: deque = deque()
 
-    assert rows != []
-
-    with open(filename, "w", newline="") as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=rows[0].keys())
-
-        writer.writeheader()
-        for row in rows:
-            writer.writerow(row)
+        def wait_first():
+            shm, future, sample, local_file = pending.popleft()
+            try:
+                future.result()
+            finally:
+                shm.unlink()
+            sample.url = f"https://{bucket_name}.s3.amazonaws.com/{local_file}"
+            sample.raw_state = {}
+            files.append((tmppath / local_file, local_file))
+            return sample
+
+        with ProcessPoolExecutor(max_workers=encoders) as executor, \
+                tqdm(unit="image") as pbar:
+            try:
+                for chunk in chunked(samples, chunk_size):
+                    images = deque(render([s.state for s in chunk]))
+
+                    for sample in chunk:
+                        # Dropping the tuple frees the depth buffer
+                        rgb, _ = images.popleft()
+                        rgb = np.ascontiguousarray(rgb)
+                        shm = to_shared_memory(rgb)
+                        local_file = f"{sample._id}.png"
+                        future = executor.submit(encode_png, shm.name, rgb.shape,
+                                                 rgb.dtype.str, tmppath / local_file)
+                        pending.append((shm, future, sample, local_file))
+                        del rgb
+
+                        while len(pending) > max_pending:
+                            yield wait_first()
+                            pbar.update(1)
+                    del images
+
+                while pending:
+                    yield wait_first()
+                    pbar.update(1)
+            except BaseException:
+                # Unlink every image still in flight, then raise the first error
+                while pending:
+                    try:
+                        wait_first()
+                    except Exception:
+                        pass
+                raise
+
+        if upload:
+            upload_files(files, bucket_name, workers=workers)
+
+
+def export_csv(filename: Path, samples: Iterable[Sample]) -> int:
+    rows = ({"sentence": s.sentence, "id": s._id, "url": s.url} for s in samples)
+    return write_groups(rows, filename, group_size=3, fmt="csv")
 
 
 if __name__ == "__main__":
@@ -77,11 +172,40 @@ if __name__ == "__main__":
     parser.add_argument("--bucket-name", "-b", type=str, required=True)
     parser.add_argument("--build", default=BUILD_FOLDER, type=Path)
     parser.add_argument("--host", default="localhost", type=str)
+    parser.add_argument("--skip-upload", action="store_true")
+    parser.add_argument("--workers", default=16, type=int)
+    parser.add_argument("--chunk-size", default=32, type=int)
+    parser.add_argument("--encoders", default=None, type=int)
+    parser.add_argument("--batch-size", default=1000, type=int)
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only export the documents added since the last build")
     args = parser.parse_args()
 
-    samples = load_samples(args.host, args.collection)
-    print(f"Found {len(samples)} samples")
-
-    render_samples(samples, args.bucket_name)
-
-    export_csv(args.build / f"batch-{args.bucket_name}", samples)
+    args.build.mkdir(parents=True, exist_ok=True)
+    after = read_last_exported(args.build, args.collection) if args.incremental else None
+
+    samples = load_samples(args.host, args.collection,
+                           batch_size=args.batch_size, after=after)
+    rendered = render_samples(samples, args.bucket_name,
+                              upload=not args.skip_upload, workers=args.workers,
+                              chunk_size=args.chunk_size, encoders=args.encoders)
+
+    last_ids: List[Any] = []
+
+    def track(samples: Iterable[Sample]) -> Iterator[Sample]:
+        for sample in samples:
+            last_ids[:] = [sample._id]
+            yield sample
+
+    # The name depends on the last _id, known only once everything is written
+    tmp_file = args.build / f"batch-{args.bucket_name}.tmp"
+    num_rows = export_csv(tmp_file, track(rendered))
+    if num_rows == 0:
+        tmp_file.unlink(missing_ok=True)
+        print("Found 0 samples")
+        sys.exit(0)
+    print(f"Exported {num_rows} groups of samples")
+
+    suffix = f"-{last_ids[0]}" if args.incremental else ""
+    os.replace(tmp_file, args.build / f"batch-{args.bucket_name}{suffix}")
+    write_last_exported(args.build, args.collection, last_ids[0])
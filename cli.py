@@ -1,20 +1,40 @@
 #!/usr/bin/env python3
 from typing import Union, List, Optional, Callable
 import logging
-import csv
 import click
-import aws
-from config import get_config
-from submit import is_job_in_records, create_job
-from generators import retrieve_generator, csv_generator
-from dataset import extract_ground_truth, generate_check_file
+
+# Modules are imported by the commands that need them, so that offline
+# commands do not pay for boto3, jinja2 or tqdm at startup.
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 @click.group()
-def cli():
-    pass
+@click.option('--check-balance',
+              default=False,
+              is_flag=True,
+              help="Log the account balance when connecting to MTurk")
+@click.option('--metrics-out',
+              default=None,
+              help="Dump per-API-call metrics to this file (JSON, or Prometheus for *.prom)")
+@click.pass_context
+def cli(ctx: click.Context, check_balance: bool = False,
+        metrics_out: Optional[str] = None):
+    ctx.obj = {'check_balance': check_balance}
+
+    if metrics_out is not None:
+        def dump_metrics():
+            from metrics import get_metrics
+            get_metrics().dump(metrics_out)
+            logging.info(f"API metrics written to {metrics_out}")
+        ctx.call_on_close(dump_metrics)
+
+
+def mturk_client():
+    """ MTurk client, only created when a command first calls it """
+    import aws
+    check_balance = click.get_current_context().obj['check_balance']
+    return aws.LazyClient(lambda: aws.connect_mturk(check_balance))
 
 @cli.command("delete", help='Delete one or several HITs')
 @click.option('--all-hits',
@@ -25,17 +45,29 @@ def cli():
               default=None,
               help="Specific HITId",
               multiple=True)
+@click.option('--expire-only',
+              default=False,
+              is_flag=True,
+              help="Only expire the HITs; delete them in a later run")
+@click.option('--workers',
+              default=16,
+              help="Number of HITs processed concurrently")
 def delete(all_hits: bool = False,
-           hit_id: Optional[List[str]] = None):
-    client = aws.connect_mturk()
+           hit_id: Optional[List[str]] = None,
+           expire_only: bool = False,
+           workers: int = 16):
+    import aws
+    from lifecycle import process_hits
+
+    client = mturk_client()
 
     if all_hits:
-        aws.delete_all_hits(client)
-    elif hit_id is not None:
-        for hit in hit_id:
-            aws.delete_hit(client, hit)
+        aws.delete_all_hits(client, expire_only, workers)
+    elif hit_id != tuple():
+        process_hits(client, list(hit_id),
+                     delete=not expire_only, workers=workers)
     else:
-        aws.delete_recorded_hits(client)
+        aws.delete_recorded_hits(client, expire_only, workers)
 
 
 @cli.command("progress", help='Show progress')
@@ -51,41 +83,78 @@ def delete(all_hits: bool = False,
               default=None,
               help="Specific HITId",
               multiple=True)
+@click.option('--workers',
+              default=16,
+              help="Number of HITs queried concurrently")
+@click.option('--watch',
+              default=False,
+              is_flag=True,
+              help="Follow the recorded HITs from MTurk notifications until they are done")
+@click.option('--reconcile-every',
+              default=300.,
+              help="Seconds between two full listings while watching")
 def progress(all_hits: bool = False,
              all_recorded: bool = False,
-             hit_id: Optional[List[str]] = None):
-
-    client = aws.connect_mturk()
-
-    if all_hits:
+             hit_id: Optional[List[str]] = None,
+             workers: int = 16,
+             watch: bool = False,
+             reconcile_every: float = 300.):
+    import aws
+
+    client = mturk_client()
+
+    if watch:
+        from clients import get_client
+        from notifications import watch_tasks
+
+        jobs = aws.list_recorded_hits(client)
+        if hit_id != tuple():
+            recorded = {job['HITId']: job for job in jobs}
+            jobs = [recorded.get(h, {'HITId': h}) for h in hit_id]
+        watch_tasks(client, get_client('sqs'), jobs, reconcile_every=reconcile_every)
+    elif all_hits:
         aws.progress_all_hits(client)
     elif all_recorded:
-        aws.progress_recorded_hits(client)
+        aws.progress_recorded_hits(client, workers=workers)
     elif hit_id != tuple():
-        aws.progress_hits(client, hit_id)
+        aws.progress_hits(client, list(hit_id), workers=workers)
     else:
         raise ValueError("No job to delete")
 
 
+@cli.command("inventory", help='Sync and query the local HIT inventory')
+@click.option('--no-sync',
+              default=False,
+              is_flag=True,
+              help="Answer from the local inventory only")
+@click.option('--status',
+              default=None,
+              help="List the HITs with this status")
+def inventory(no_sync: bool = False,
+              status: Optional[str] = None):
+    from inventory import get_inventory
+
+    hits = get_inventory()
+    if not no_sync:
+        hits.sync(mturk_client())
+
+    if status is not None:
+        for hit_id in hits.hit_ids(status):
+            print(hit_id)
+    else:
+        for name, num_hits in sorted(hits.count_by_status().items()):
+            print(f"{name}: {num_hits}")
+
+
 @cli.command("ground-truth", help="Retrieve ground truth")
 @click.argument('csv-file',
                 type=str)
 @click.argument('dataset',
                 type=str)
 def ground_truth(csv_file: str, dataset: str):
-    rows = []
-    with open(csv_file, 'r', newline='') as fid:
-        header = next(fid).split(',')
-        reader = csv.reader(fid, delimiter=',')
-        for row in reader:
-            ground_truth = extract_ground_truth(dataset, row[0], row[1])
-            row.append(ground_truth)
-            rows.append(row)
+    from dataset import add_ground_truth
 
-    with open(csv_file, 'w', newline='') as fid:
-        writer = csv.writer(fid, delimiter=',')
-        for row in rows:
-            writer.writerow(row)
+    add_ground_truth(csv_file, dataset)
 
 
 @cli.command("check-generator", help="Generate data for the check step")
@@ -94,6 +163,8 @@ def ground_truth(csv_file: str, dataset: str):
 @click.argument('output',
                 type=str)
 def check_generator(csv_file: str, output: str):
+    from dataset import generate_check_file
+
     generate_check_file(csv_file, output)
 
 
@@ -107,49 +178,159 @@ def check_generator(csv_file: str, output: str):
 @click.option('--message',
               default='Your answer is really helpful for our research! Hoping to get more answers from you!')
 @click.option('--output',
-              default='',
+              default='bonus.csv',
               help='Output CSV file to register the bonus')
+@click.option('--workers',
+              default=8,
+              help="Number of bonuses sent concurrently")
 def bonus(from_csv: Optional[str] = None,
           amount: float = 0.,
           message: str = "",
-          output: str = ""):
-
-    client = aws.connect_mturk()
-    assignments = []
-    workers = []
-    done = []
-
-    if output != "":
-        with open(output, 'r', newline='') as fid:
-            reader = csv.reader(fid, delimiter=',')
-            for row in reader:
-                done.append(row[0])
-
-    if from_csv is not None:
-        with open(from_csv, 'r', newline='') as fid:
-            header = next(fid).split(',')
-            reader = csv.reader(fid, delimiter=',')
-            for row in reader:
-                row_dict = {k: v for k, v in zip(header, row)}
-                assignment_id = row_dict['assignment_id']
-
-                if assignment_id in done:
-                    continue
-
-                if assignment_id not in assignments:
-                    assignments.append(assignment_id)
-                    workers.append(row_dict['worker_id'])
-    else:
+          output: str = "bonus.csv",
+          workers: int = 8):
+
+    if from_csv is None:
         raise ValueError("No job to reward")
 
-    for assignment, worker in zip(assignments, workers):
-        aws.send_bonus(client, assignment, worker, amount, message)
+    from bonus import pay_bonuses
+
+    client = mturk_client()
+    pay_bonuses(client, from_csv, output, amount, message, workers=workers)
+
 
-    if output != "":
-        with open(output, 'a', newline='') as fid:
-            writer = csv.writer(fid, delimiter=',')
-            for assignment, worker in zip(assignments, workers):
-                writer.writerow(assignment, worker, amount, message)
+@cli.command("harvest", help='Download the new assignments of recorded HITs')
+@click.argument('output',
+                type=str)
+@click.option('--name',
+              default=None,
+              help="Only harvest this task",
+              multiple=True)
+@click.option('--workers',
+              default=16,
+              help="Number of HITs queried concurrently")
+def harvest_results(output: str,
+                    name: Optional[List[str]] = None,
+                    workers: int = 16):
+    import aws
+    from harvest import harvest
+
+    client = mturk_client()
+
+    jobs = aws.list_recorded_hits(client)
+    if name != tuple():
+        jobs = [job for job in jobs if job.get('task_name') in name]
+
+    harvest(client, jobs, output, workers=workers)
+
+
+@cli.command("analyze", help='Worker accuracy and answer agreement of result files')
+@click.argument('csv-files',
+                type=str,
+                nargs=-1,
+                required=True)
+@click.option('--dataset',
+              default=None,
+              help="Dataset folder with the ground truth, if the files have no ground_truth column")
+@click.option('--report',
+              default=None,
+              help="Write the per-worker, per-item and answer statistics to this JSON file")
+@click.option('--block-list',
+              default=None,
+              help="Write the workers scoring below --block-below to this CSV file")
+@click.option('--qualify-list',
+              default=None,
+              help="Write the workers scoring at least --qualify-above to this CSV file")
+@click.option('--block-below',
+              default=0.3,
+              help="Score under which a worker is listed to be blocked")
+@click.option('--qualify-above',
+              default=0.8,
+              help="Score from which a worker is listed to be qualified")
+@click.option('--min-answers',
+              default=10,
+              help="Answers a worker needs before being listed")
+def analyze_results(csv_files: List[str],
+                    dataset: Optional[str] = None,
+                    report: Optional[str] = None,
+                    block_list: Optional[str] = None,
+                    qualify_list: Optional[str] = None,
+                    block_below: float = 0.3,
+                    qualify_above: float = 0.8,
+                    min_answers: int = 10):
+    from analytics import analyze
+
+    ground_truth = None
+    if dataset is not None:
+        from dataset import GroundTruthIndex
+        ground_truth = GroundTruthIndex(dataset)
+        ground_truth.refresh()
+
+    analyze(csv_files, ground_truth,
+            report=report,
+            block_list=block_list,
+            qualify_list=qualify_list,
+            block_below=block_below,
+            qualify_above=qualify_above,
+            min_answers=min_answers)
+
+
+@cli.command("review", help='Approve or reject harvested assignments against ground truth')
+@click.argument('results',
+                type=str)
+@click.option('--dataset',
+              default=None,
+              help="Dataset folder with the ground-truth annotations")
+@click.option('--reference',
+              default=None,
+              help="JSONL or CSV file of expected colors, e.g. agreed check answers")
+@click.option('--min-score',
+              default=0.5,
+              help="Assignments scoring below are rejected")
+@click.option('--message',
+              default="The colors you reported do not match the tower described.",
+              help="Feedback sent with a rejection")
+@click.option('--batch-size',
+              default=500,
+              help="Number of assignments scored together")
+@click.option('--workers',
+              default=16,
+              help="Number of decisions sent concurrently")
+@click.option('--rate',
+              default=10.,
+              help="Maximum number of MTurk calls per second")
+@click.option('--dry-run',
+              default=False,
+              is_flag=True,
+              help="Score and count the decisions without sending them")
+def review_results(results: str,
+                   dataset: Optional[str] = None,
+                   reference: Optional[str] = None,
+                   min_score: float = 0.5,
+                   message: str = "",
+                   batch_size: int = 500,
+                   workers: int = 16,
+                   rate: float = 10.,
+                   dry_run: bool = False):
+
+    if (dataset is None) == (reference is None):
+        raise ValueError("Give either --dataset or --reference")
+
+    from review import review, ReferenceAnswers
+
+    if dataset is not None:
+        from dataset import GroundTruthIndex
+        answers = GroundTruthIndex(dataset)
+        answers.refresh()
+    else:
+        answers = ReferenceAnswers(reference)
+
+    review(mturk_client(), results, answers,
+           min_score=min_score,
+           message=message,
+           batch_size=batch_size,
+           workers=workers,
+           rate=rate,
+           dry_run=dry_run)
 
 
 @cli.command("submit", help='Submit one or several HITs')
@@ -168,15 +349,48 @@ def bonus(from_csv: Optional[str] = None,
 @click.option('--from-csv',
               default=None,
               help="From CSV records")
+@click.option('--chunk-size',
+              default=50,
+              help="Number of samples rendered together")
+@click.option('--workers',
+              default=8,
+              help="Number of HITs created concurrently")
+@click.option('--rate',
+              default=5.,
+              help="Maximum number of MTurk calls per second")
+@click.option('--shard',
+              default=0,
+              help="Index of the shard of samples to submit")
+@click.option('--num-shards',
+              default=1,
+              help="Split the samples into this number of shards")
+@click.option('--max-live',
+              default=None,
+              type=click.IntRange(min=1),
+              help="Keep at most this number of HITs of a task live; new ones wait for slots")
+@click.option('--poll-interval',
+              default=60.,
+              help="Seconds between two checks of the live HITs with --max-live")
 def submit(allow_duplicate: bool = False,
            name: Optional[List[str]] = None,
            all_tasks: bool = False,
-           from_csv: Optional[str] = None):
+           from_csv: Optional[str] = None,
+           chunk_size: int = 50,
+           workers: int = 8,
+           rate: float = 5.,
+           shard: int = 0,
+           num_shards: int = 1,
+           max_live: Optional[int] = None,
+           poll_interval: float = 60.):
 
     if name == tuple() and not all_tasks:
         raise ValueError("No task to submit")
 
-    client = aws.connect_mturk()
+    from config import get_config
+    from generators import retrieve_generator, csv_generator
+    from submit import submit_samples
+
+    client = mturk_client()
 
     config = get_config()
     tasks = config['tasks']
@@ -189,14 +403,19 @@ def submit(allow_duplicate: bool = False,
 
         if from_csv is None:
             generator_name = retrieve_generator(task['name'])
-            generator = generator_name(client)
+            generator = generator_name(client, shard=shard, num_shards=num_shards)
         else:
-            generator = csv_generator(client, from_csv)
-
-        for sample in generator:
-            if not allow_duplicate \
-                    and not is_job_in_records(task['name'], sample):
-                create_job(client, task, sample)
+            generator = csv_generator(client, from_csv,
+                                      shard=shard, num_shards=num_shards)
+
+        num_jobs = submit_samples(client, task, generator,
+                                  workers=workers,
+                                  rate=rate,
+                                  chunk_size=chunk_size,
+                                  allow_duplicate=allow_duplicate,
+                                  max_live=max_live,
+                                  poll_interval=poll_interval)
+        logging.info(f"{num_jobs} HITs were submitted for {task['name']}")
 
 
 if __name__ == "__main__":
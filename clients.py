@@ -0,0 +1,104 @@
+from typing import Any, Callable, Dict, Optional
+import threading
+import boto3
+from botocore.config import Config
+from config import get_config
+from metrics import get_metrics
+
+
+DEFAULTS = {
+    'max_pool_connections': 32,
+    'max_attempts': 10,
+    'connect_timeout': 5,
+    'read_timeout': 30,
+}
+
+# Every MTurk call goes through throttle.call_with_backoff, which owns the
+# retries and reports them to the metrics; botocore retrying too would
+# multiply the attempts (max_attempts counts the retries after the first one).
+SERVICE_DEFAULTS: Dict[str, Dict[str, Any]] = {
+    'mturk': {'max_attempts': 0},
+}
+
+
+def client_config(max_pool_connections: int = DEFAULTS['max_pool_connections'],
+                  max_attempts: int = DEFAULTS['max_attempts'],
+                  connect_timeout: float = DEFAULTS['connect_timeout'],
+                  read_timeout: float = DEFAULTS['read_timeout']) -> Config:
+    """ botocore settings for clients shared by many threads """
+    return Config(max_pool_connections=max_pool_connections,
+                  retries={'mode': 'adaptive', 'max_attempts': max_attempts},
+                  connect_timeout=connect_timeout,
+                  read_timeout=read_timeout)
+
+
+def make_client(service: str, settings: Optional[Dict[str, Any]] = None,
+                **kwargs: Any) -> Any:
+    """ A new boto3 client with the settings of the shared ones, and metrics
+
+    `settings` override DEFAULTS and SERVICE_DEFAULTS; `kwargs` go to
+    boto3.client, e.g. credentials. Without them, boto3 finds the
+    credentials itself, so no repo config is needed.
+    """
+    settings = {**DEFAULTS, **SERVICE_DEFAULTS.get(service, {}), **(settings or {})}
+    client = boto3.client(service, config=client_config(**settings), **kwargs)
+    get_metrics().attach(client)
+    return client
+
+
+class ClientManager:
+    """ Hands out one shared client per service
+
+    boto3 clients are thread-safe, so a single client per service, with a
+    connection pool sized for the worker threads, serves every command.
+    A factory can be registered for a service, e.g. to plug in a fake MTurk.
+    """
+
+    def __init__(self):
+        self._clients: Dict[str, Any] = {}
+        self._factories: Dict[str, Callable[[], Any]] = {}
+        self._lock = threading.Lock()
+
+    def register(self, service: str, factory: Callable[[], Any]) -> None:
+        with self._lock:
+            self._factories[service] = factory
+            self._clients.pop(service, None)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._clients.clear()
+
+    def get(self, service: str) -> Any:
+        client = self._clients.get(service)
+        if client is not None:
+            return client
+        with self._lock:
+            if service not in self._clients:
+                factory = self._factories.get(service)
+                self._clients[service] = factory() if factory is not None \
+                    else self._create(service)
+            return self._clients[service]
+
+    def _create(self, service: str) -> Any:
+        config = get_config()
+        aws = config['aws']
+        settings = {**config.get('clients', {}), **SERVICE_DEFAULTS.get(service, {})}
+        endpoint_url: Optional[str] = config.get(service, {}).get('endpoint_url')
+
+        return make_client(service, settings,
+                           aws_access_key_id=aws['access_key_id'] or None,
+                           aws_secret_access_key=aws['secret_access_key'] or None,
+                           region_name=aws['region_name'],
+                           endpoint_url=endpoint_url)
+
+
+_manager = ClientManager()
+
+
+def get_client(service: str) -> Any:
+    return _manager.get(service)
+
+
+def register_client(service: str, factory: Callable[[], Any]) -> None:
+    """ Use factory() instead of boto3 for this service, e.g. a fake endpoint """
+    _manager.register(service, factory)
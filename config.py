@@ -1,22 +1,89 @@
 from pathlib import Path
-from typing import Any, Dict, Optional
+from types import MappingProxyType
+from typing import Any, Mapping, Optional, Tuple
 import logging
+import re
+import threading
+import time
 import yaml
 
 
-def get_config(sub: Optional[str] = None) -> Dict[str, Any]:
+CONFIG_FOLDER = Path() / "config"
+
+# How often (in seconds) the config folder is checked for modified files
+CHECK_INTERVAL = 1.0
+
+_lock = threading.Lock()
+_snapshot: Optional[Mapping[str, Any]] = None
+_signature: Optional[Tuple] = None
+_checked_at = 0.0
+
+
+def _priority(config_file: Path) -> Tuple[int, str]:
+    """ Leading number of the file name, e.g. 1 for 01-local.yaml; ties go by name """
+    return int(re.match(r"\d+", config_file.name).group()), config_file.name
+
+
+def _freeze(value: Any) -> Any:
+    """ Turn the parsed YAML into read-only mappings and tuples """
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _signature_of(config_folder: Path) -> Tuple:
+    return tuple(sorted((f.name, f.stat().st_mtime_ns)
+                        for f in config_folder.glob("[0-9]*yaml")))
+
+
+def _load(config_folder: Path) -> Mapping[str, Any]:
     """ find the config file with the biggest number """
-    config_folder = Path() / "config"
-    files = [f.stem for f in config_folder.glob("[0-9]*yaml")]
-    priorities = [f.split(".")[0] for f in files]
-    best_idx = max(enumerate(priorities), key=lambda x: x[1])[0]
+    files = list(config_folder.glob("[0-9]*yaml"))
+    config_file = max(files, key=_priority)
 
-    # load the config
-    config_file = config_folder / (files[best_idx] + ".yaml")
     try:
         with open(config_file, 'r') as ymlfile:
             config = yaml.safe_load(ymlfile)
     except yaml.YAMLError as err:
         logging.error(err)
+        raise
+
+    return _freeze(config)
+
+
+def get_config(sub: Optional[str] = None) -> Mapping[str, Any]:
+    """ Return a read-only snapshot of the config file with the biggest number
+
+    The snapshot is parsed once and reloaded only when a config file changes.
+    """
+    global _snapshot, _signature, _checked_at
+
+    now = time.monotonic()
+    if _snapshot is None or now - _checked_at > CHECK_INTERVAL:
+        with _lock:
+            signature = _signature_of(CONFIG_FOLDER)
+            if _snapshot is None or signature != _signature:
+                _snapshot = _load(CONFIG_FOLDER)
+                _signature = signature
+            _checked_at = now
+
+    return _snapshot if sub is None else _snapshot[sub]
+
+
+def reload_config() -> Mapping[str, Any]:
+    """ Drop the cached snapshot """
+    global _snapshot
+    with _lock:
+        _snapshot = None
+    return get_config()
+
 
-    return config if sub is None else config[sub]
+def thaw(value: Any) -> Any:
+    """ Return a mutable copy of a config snapshot """
+    if isinstance(value, Mapping):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(v) for v in value]
+    return value
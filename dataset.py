@@ -1,7 +1,11 @@
-from typing import Union
+from typing import Any, Dict, Iterator, Optional, Union
 from pathlib import Path
 import json
 import csv
+import logging
+import os
+import sqlite3
+from batch import write_groups
 
 
 def extract_ground_truth(dataset_folder: Union[Path, str],
@@ -19,34 +23,132 @@ def extract_ground_truth(dataset_folder: Union[Path, str],
     return ground_truth['color']
 
 
-def generate_check_file(csv_file: Union[Path, str],
-                        output_file: Union[Path, str]):
-    """ Extract the sequence of colors """
+class GroundTruthIndex:
+    """ SQLite index of the colors of every annotation, keyed by (num_cubes, ref)
 
-    assert Path(csv_file).is_file(), f"Can't find {csv_file}"
+    It lives in the dataset folder. A refresh only re-parses the
+    annotation files whose mtime changed since the last one.
+    """
 
-    annotations = []
+    def __init__(self, dataset_folder: Union[Path, str],
+                 filename: Optional[Union[Path, str]] = None):
+        self.dataset_folder = Path(dataset_folder)
+        assert self.dataset_folder.is_dir(), f"Can't find {self.dataset_folder}"
 
-    with open(csv_file, 'r', newline='') as fid:
-        header = next(fid).split(',')
-        reader = csv.reader(fid, delimiter=',')
+        if filename is None:
+            filename = self.dataset_folder / "ground_truth.sqlite"
+        self.db = sqlite3.connect(str(filename))
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS ground_truth (
+                num_cubes INTEGER,
+                ref INTEGER,
+                color TEXT,
+                mtime INTEGER,
+                PRIMARY KEY (num_cubes, ref)
+            )""")
+        self.db.commit()
+        self._cache: Dict[Any, Any] = {}
 
-        for row in reader:
-            row_dict = {k: v for k, v in zip(header, row)}
-            
-            if row_dict['status'] in ['approved', 'to approve']:
-                annotate = {'answer': row_dict['answer'],
-                            'num_cubes': row_dict['numCubes'],
-                            'ref': row_dict['ref']}
+    def _scan(self):
+        """ Yield (num_cubes, ref, path, mtime) for every annotation file """
+        for cubes_entry in os.scandir(self.dataset_folder):
+            if not cubes_entry.is_dir() or not cubes_entry.name.isdigit():
+                continue
+            for ref_entry in os.scandir(cubes_entry.path):
+                if not ref_entry.is_dir() or not ref_entry.name.isdigit():
+                    continue
+                path = os.path.join(ref_entry.path, "annotation.json")
+                try:
+                    mtime = os.stat(path).st_mtime_ns
+                except FileNotFoundError:
+                    continue
+                yield int(cubes_entry.name), int(ref_entry.name), path, mtime
+
+    def refresh(self) -> Dict[str, int]:
+        known = {(n, r): mtime for n, r, mtime in
+                 self.db.execute("SELECT num_cubes, ref, mtime FROM ground_truth")}
+        seen = set()
+        changed = []
+
+        for num_cubes, ref, path, mtime in self._scan():
+            seen.add((num_cubes, ref))
+            if known.get((num_cubes, ref)) == mtime:
+                continue
+            with open(path, "r") as fid:
+                color = json.load(fid)['color']
+            changed.append((num_cubes, ref, json.dumps(color), mtime))
+
+        gone = [key for key in known if key not in seen]
+
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO ground_truth VALUES (?, ?, ?, ?)", changed)
+            self.db.executemany(
+                "DELETE FROM ground_truth WHERE num_cubes = ? AND ref = ?", gone)
+        self._cache.clear()
+
+        stats = {'parsed': len(changed), 'deleted': len(gone), 'total': len(seen)}
+        logging.info(f"Ground truth index refreshed: {stats}")
+        return stats
+
+    def get(self, num_cubes: int, ref: int) -> Any:
+        key = (int(num_cubes), int(ref))
+        if key not in self._cache:
+            row = self.db.execute(
+                "SELECT color FROM ground_truth WHERE num_cubes = ? AND ref = ?",
+                key).fetchone()
+            if row is None:
+                raise ValueError(f"Can't find the annotation {num_cubes}/{ref}")
+            self._cache[key] = json.loads(row[0])
+        return self._cache[key]
+
+
+def add_ground_truth(csv_file: Union[Path, str],
+                     dataset_folder: Union[Path, str]) -> None:
+    """ Append the ground truth to each row of a result file
 
-                annotations.append(annotate)
+    The file is streamed into a temporary file that atomically replaces it.
+    """
+    index = GroundTruthIndex(dataset_folder)
+    index.refresh()
 
-    with open(output_file, "w") as fid:
-        buffer = []
-        for annotate in annotations:
-            buffer.append(annotate)
+    csv_file = Path(csv_file)
+    tmp_file = csv_file.with_name(csv_file.name + ".tmp")
 
-            if len(buffer) == 3:
-                fid.write(json.dumps(buffer))
-                fid.write('\n')
-                buffer.clear()
+    try:
+        with open(csv_file, 'r', newline='') as fin, \
+                open(tmp_file, 'w', newline='') as fout:
+            reader = csv.reader(fin, delimiter=',')
+            writer = csv.writer(fout, delimiter=',')
+            header = next(reader)
+            writer.writerow(header + ['ground_truth'])
+            for row in reader:
+                writer.writerow(row + [index.get(row[0], row[1])])
+            fout.flush()
+            os.fsync(fout.fileno())
+    except BaseException:
+        tmp_file.unlink(missing_ok=True)
+        raise
+
+    os.replace(tmp_file, csv_file)
+
+
+def iter_check_samples(csv_file: Union[Path, str]) -> Iterator[Dict[str, str]]:
+    """ Stream the approved answers of a result file """
+
+    assert Path(csv_file).is_file(), f"Can't find {csv_file}"
+
+    with open(csv_file, 'r', newline='') as fid:
+        for row_dict in csv.DictReader(fid, delimiter=','):
+            if row_dict['status'] in ['approved', 'to approve']:
+                yield {'answer': row_dict['answer'],
+                       'num_cubes': row_dict['numCubes'],
+                       'ref': row_dict['ref']}
+
+
+def generate_check_file(csv_file: Union[Path, str],
+                        output_file: Union[Path, str],
+                        group_size: int = 3):
+    """ Extract the sequence of colors """
+    write_groups(iter_check_samples(csv_file), output_file,
+                 group_size=group_size, fmt='jsonl')
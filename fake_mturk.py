@@ -0,0 +1,370 @@
+from typing import Any, Dict, Iterator, List, Optional
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from xml.sax.saxutils import escape
+import json
+import random
+import threading
+import time
+import uuid
+from botocore.exceptions import ClientError
+
+
+ANSWER = ('<?xml version="1.0" encoding="ASCII"?>'
+          '<QuestionFormAnswers xmlns="http://mechanicalturk.amazonaws.com/'
+          'AWSMechanicalTurkDataSchemas/2005-10-01/QuestionFormAnswers.xsd">'
+          '<Answer><QuestionIdentifier>output</QuestionIdentifier>'
+          '<FreeText>{output}</FreeText></Answer></QuestionFormAnswers>')
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class FakeMTurk:
+    """ In-process stand-in for the boto3 MTurk client
+
+    Every call sleeps `latency` seconds, then raises a ThrottlingException
+    with probability `throttle_rate` or a ServiceFault with probability
+    `failure_rate`. It is thread-safe and counts the calls per operation.
+    Register it with clients.register_client('mturk', FakeMTurk) to drive
+    the real code without network.
+    """
+
+    def __init__(self, latency: float = 0., throttle_rate: float = 0.,
+                 failure_rate: float = 0., seed: int = 0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.failure_rate = failure_rate
+        self.calls: Counter = Counter()
+        self.hit_types: Dict[str, Dict[str, Any]] = {}
+        self.hits: Dict[str, Dict[str, Any]] = {}
+        self.assignments: Dict[str, List[Dict[str, Any]]] = {}
+        self.bonuses: Dict[str, Dict[str, Any]] = {}
+        self.notifications: Dict[str, Dict[str, Any]] = {}
+        self._assignment_hits: Dict[str, str] = {}
+        self.queues: Dict[str, Any] = {}
+        self._tokens: Dict[str, str] = {}
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+
+    def _call(self, operation: str) -> None:
+        if self.latency > 0:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls[operation] += 1
+            draw = self._random.random()
+        if draw < self.throttle_rate:
+            raise ClientError({'Error': {'Code': 'ThrottlingException',
+                                         'Message': 'Rate exceeded'}}, operation)
+        if draw < self.throttle_rate + self.failure_rate:
+            raise ClientError({'Error': {'Code': 'ServiceFault',
+                                         'Message': 'Injected failure'}}, operation)
+
+    @staticmethod
+    def _error(operation: str, message: str,
+               turk_error_code: Optional[str] = None) -> ClientError:
+        response: Dict[str, Any] = {'Error': {'Code': 'RequestError', 'Message': message}}
+        if turk_error_code is not None:
+            response['TurkErrorCode'] = turk_error_code
+        return ClientError(response, operation)
+
+    def _check_token(self, operation: str, token: Optional[str], value: str) -> None:
+        if token is None:
+            return
+        if token in self._tokens:
+            if operation.startswith('CreateHIT'):
+                # Like MTurk, name the HIT created with this token
+                raise self._error(operation, f"The HIT {self._tokens[token]} already "
+                                  "exists with this token",
+                                  'AWS.MechanicalTurk.HitAlreadyExists')
+            raise self._error(operation, "The token has already been used")
+        self._tokens[token] = value
+
+    def _refresh(self, hit: Dict[str, Any]) -> None:
+        """ Expire the HIT when its time is over """
+        if hit['HITStatus'] not in ('Assignable', 'Unassignable'):
+            return
+        if hit['Expiration'] <= _now():
+            hit['HITStatus'] = 'Reviewable'
+            self._notify(hit, [{'EventType': 'HITExpired'}])
+        elif hit['NumberOfAssignmentsAvailable'] == 0:
+            hit['HITStatus'] = 'Reviewable'
+            self._notify(hit, [{'EventType': 'HITReviewable'}])
+
+    def _notify(self, hit: Dict[str, Any], events: List[Dict[str, Any]]) -> None:
+        """ Send the events to the queue attached to the HIT type, if any """
+        settings = self.notifications.get(hit['HITTypeId'])
+        if not settings or not settings['Active'] or not settings['Notification']:
+            return
+        notification = settings['Notification']
+        queue = self.queues.get(notification['Destination'])
+        events = [{**event, 'EventTimestamp': _now().isoformat(),
+                   'HITId': hit['HITId'], 'HITTypeId': hit['HITTypeId']}
+                  for event in events
+                  if event['EventType'] in notification['EventTypes']]
+        if queue is not None and events:
+            queue.send_message(MessageBody=json.dumps({
+                'Events': events,
+                'EventDocVersion': notification['Version']}))
+
+    # Account
+
+    def get_account_balance(self) -> Dict[str, Any]:
+        self._call('GetAccountBalance')
+        return {'AvailableBalance': '10000.00'}
+
+    # HIT types and HITs
+
+    def create_hit_type(self, **kwargs: Any) -> Dict[str, Any]:
+        self._call('CreateHITType')
+        hit_type_id = uuid.uuid4().hex[:30].upper()
+        with self._lock:
+            self.hit_types[hit_type_id] = kwargs
+        return {'HITTypeId': hit_type_id}
+
+    def _new_hit(self, hit_type_id: str, params: Dict[str, Any],
+                 max_assignments: int, lifetime: int, question: str) -> Dict[str, Any]:
+        now = _now()
+        return {'HITId': uuid.uuid4().hex[:30].upper(),
+                'HITTypeId': hit_type_id,
+                'HITGroupId': hit_type_id,
+                'CreationTime': now,
+                'Title': params.get('Title', ''),
+                'Description': params.get('Description', ''),
+                'Question': question,
+                'Keywords': params.get('Keywords', ''),
+                'HITStatus': 'Assignable',
+                'MaxAssignments': int(max_assignments),
+                'Reward': params.get('Reward', '0'),
+                'AutoApprovalDelayInSeconds': params.get('AutoApprovalDelayInSeconds', 0),
+                'Expiration': now + timedelta(seconds=int(lifetime)),
+                'AssignmentDurationInSeconds': params.get('AssignmentDurationInSeconds', 0),
+                'NumberOfAssignmentsPending': 0,
+                'NumberOfAssignmentsAvailable': int(max_assignments),
+                'NumberOfAssignmentsCompleted': 0}
+
+    def create_hit(self, MaxAssignments: int, LifetimeInSeconds: int,
+                   Question: str, UniqueRequestToken: Optional[str] = None,
+                   **kwargs: Any) -> Dict[str, Any]:
+        self._call('CreateHIT')
+        hit = self._new_hit('FAKETYPE', kwargs, MaxAssignments,
+                            LifetimeInSeconds, Question)
+        with self._lock:
+            self._check_token('CreateHIT', UniqueRequestToken, hit['HITId'])
+            self.hits[hit['HITId']] = hit
+            self.assignments[hit['HITId']] = []
+        return {'HIT': dict(hit)}
+
+    def create_hit_with_hit_type(self, HITTypeId: str, MaxAssignments: int,
+                                 LifetimeInSeconds: int, Question: str,
+                                 UniqueRequestToken: Optional[str] = None,
+                                 **kwargs: Any) -> Dict[str, Any]:
+        self._call('CreateHITWithHITType')
+        with self._lock:
+            if HITTypeId not in self.hit_types:
+                raise self._error('CreateHITWithHITType', f"Unknown HIT type {HITTypeId}")
+            hit = self._new_hit(HITTypeId, self.hit_types[HITTypeId],
+                                MaxAssignments, LifetimeInSeconds, Question)
+            self._check_token('CreateHITWithHITType', UniqueRequestToken, hit['HITId'])
+            self.hits[hit['HITId']] = hit
+            self.assignments[hit['HITId']] = []
+        return {'HIT': dict(hit)}
+
+    def get_hit(self, HITId: str) -> Dict[str, Any]:
+        self._call('GetHIT')
+        with self._lock:
+            if HITId not in self.hits:
+                raise self._error('GetHIT', f"Hit {HITId} does not exist")
+            hit = self.hits[HITId]
+            self._refresh(hit)
+            return {'HIT': dict(hit)}
+
+    def list_hits(self, MaxResults: int = 10,
+                  NextToken: Optional[str] = None) -> Dict[str, Any]:
+        self._call('ListHITs')
+        start = int(NextToken or 0)
+        with self._lock:
+            hit_ids = list(self.hits)[start:start + MaxResults]
+            hits = []
+            for hit_id in hit_ids:
+                self._refresh(self.hits[hit_id])
+                hits.append(dict(self.hits[hit_id]))
+            total = len(self.hits)
+        response = {'NumResults': len(hits), 'HITs': hits}
+        if start + MaxResults < total:
+            response['NextToken'] = str(start + MaxResults)
+        return response
+
+    def update_expiration_for_hit(self, HITId: str, ExpireAt: datetime) -> Dict[str, Any]:
+        self._call('UpdateExpirationForHIT')
+        with self._lock:
+            if HITId not in self.hits:
+                raise self._error('UpdateExpirationForHIT', f"Hit {HITId} does not exist")
+            hit = self.hits[HITId]
+            if hit['HITStatus'] not in ('Assignable', 'Unassignable'):
+                raise self._error('UpdateExpirationForHIT', "The HIT is not active")
+            expire_at = ExpireAt if ExpireAt.tzinfo else ExpireAt.replace(tzinfo=timezone.utc)
+            hit['Expiration'] = expire_at
+            self._refresh(hit)
+        return {}
+
+    def delete_hit(self, HITId: str) -> Dict[str, Any]:
+        self._call('DeleteHIT')
+        with self._lock:
+            if HITId not in self.hits:
+                raise self._error('DeleteHIT', f"Hit {HITId} does not exist")
+            hit = self.hits[HITId]
+            self._refresh(hit)
+            if hit['HITStatus'] != 'Reviewable' or any(
+                    a['AssignmentStatus'] == 'Submitted' for a in self.assignments[HITId]):
+                raise self._error('DeleteHIT', "This HIT is currently in the state "
+                                  f"'{hit['HITStatus']}' and can't be deleted")
+            del self.hits[HITId]
+            del self.assignments[HITId]
+        return {}
+
+    # Assignments
+
+    def list_assignments_for_hit(self, HITId: str, MaxResults: int = 10,
+                                 NextToken: Optional[str] = None,
+                                 AssignmentStatuses: Optional[List[str]] = None
+                                 ) -> Dict[str, Any]:
+        self._call('ListAssignmentsForHIT')
+        start = int(NextToken or 0)
+        with self._lock:
+            if HITId not in self.hits:
+                raise self._error('ListAssignmentsForHIT', f"Hit {HITId} does not exist")
+            assignments = [dict(a) for a in self.assignments[HITId]
+                           if AssignmentStatuses is None
+                           or a['AssignmentStatus'] in AssignmentStatuses]
+        page = assignments[start:start + MaxResults]
+        response = {'NumResults': len(page), 'Assignments': page}
+        if start + MaxResults < len(assignments):
+            response['NextToken'] = str(start + MaxResults)
+        return response
+
+    def get_paginator(self, operation: str) -> 'FakePaginator':
+        if operation != 'list_assignments_for_hit':
+            raise NotImplementedError(operation)
+        return FakePaginator(self.list_assignments_for_hit)
+
+    def _review(self, operation: str, assignment_id: str, status: str) -> Dict[str, Any]:
+        self._call(operation)
+        with self._lock:
+            hit_id = self._assignment_hits.get(assignment_id)
+            if hit_id not in self.assignments:
+                raise self._error(operation, f"Assignment {assignment_id} does not exist")
+            assignment = next(a for a in self.assignments[hit_id]
+                              if a['AssignmentId'] == assignment_id)
+            if assignment['AssignmentStatus'] != 'Submitted':
+                raise self._error(operation, "This operation can be called "
+                                  "with a status of: Submitted")
+            assignment['AssignmentStatus'] = status
+            self.hits[hit_id]['NumberOfAssignmentsCompleted'] += 1
+        return {}
+
+    def approve_assignment(self, AssignmentId: str, **kwargs: Any) -> Dict[str, Any]:
+        return self._review('ApproveAssignment', AssignmentId, 'Approved')
+
+    def reject_assignment(self, AssignmentId: str, **kwargs: Any) -> Dict[str, Any]:
+        return self._review('RejectAssignment', AssignmentId, 'Rejected')
+
+    def send_bonus(self, WorkerId: str, BonusAmount: str, AssignmentId: str,
+                   Reason: str, UniqueRequestToken: Optional[str] = None) -> Dict[str, Any]:
+        self._call('SendBonus')
+        with self._lock:
+            self._check_token('SendBonus', UniqueRequestToken, AssignmentId)
+            self.bonuses[AssignmentId] = {'WorkerId': WorkerId,
+                                          'BonusAmount': BonusAmount,
+                                          'Reason': Reason}
+        return {}
+
+    def list_bonus_payments(self, AssignmentId: Optional[str] = None,
+                            HITId: Optional[str] = None,
+                            MaxResults: int = 100,
+                            NextToken: Optional[str] = None) -> Dict[str, Any]:
+        self._call('ListBonusPayments')
+        with self._lock:
+            payments = [{'AssignmentId': assignment_id, **bonus}
+                        for assignment_id, bonus in self.bonuses.items()
+                        if AssignmentId in (None, assignment_id)
+                        and (HITId is None or self._assignment_hits.get(assignment_id) == HITId)]
+        return {'NumResults': len(payments), 'BonusPayments': payments}
+
+    def update_notification_settings(self, HITTypeId: str,
+                                     Notification: Optional[Dict[str, Any]] = None,
+                                     Active: bool = True) -> Dict[str, Any]:
+        self._call('UpdateNotificationSettings')
+        with self._lock:
+            self.notifications[HITTypeId] = {'Notification': Notification,
+                                             'Active': Active}
+        return {}
+
+    # Simulation helpers, not part of the MTurk API
+
+    def attach_queue(self, destination: str, queue: Any) -> None:
+        """ Deliver the notifications for `destination` to a local queue """
+        self.queues[destination] = queue
+
+    def simulate_work(self, fraction: float = 1., num_workers: int = 50,
+                      answer: Optional[Any] = None) -> int:
+        """ Let workers submit `fraction` of the available assignments """
+        output = escape(json.dumps(answer if answer is not None
+                                   else [{'stepByStep': 'Put the red cube on the blue one.'}]))
+        num_submitted = 0
+        with self._lock:
+            for hit_id, hit in self.hits.items():
+                if hit['HITStatus'] != 'Assignable':
+                    continue
+                todo = round(hit['NumberOfAssignmentsAvailable'] * fraction)
+                submitted = []
+                for _ in range(todo):
+                    assignment_id = uuid.uuid4().hex[:30].upper()
+                    self._assignment_hits[assignment_id] = hit_id
+                    self.assignments[hit_id].append({
+                        'AssignmentId': assignment_id,
+                        'WorkerId': f"W{self._random.randrange(num_workers):05d}",
+                        'HITId': hit_id,
+                        'AssignmentStatus': 'Submitted',
+                        'AcceptTime': _now(),
+                        'SubmitTime': _now(),
+                        'Answer': ANSWER.format(output=output)})
+                    hit['NumberOfAssignmentsAvailable'] -= 1
+                    submitted.append({'EventType': 'AssignmentSubmitted',
+                                      'AssignmentId': assignment_id})
+                    num_submitted += 1
+                if submitted:
+                    self._notify(hit, submitted)
+                self._refresh(hit)
+        return num_submitted
+
+    def review_all(self, status: str = 'Approved') -> int:
+        """ Approve (or reject) every submitted assignment at once """
+        num_reviewed = 0
+        with self._lock:
+            for hit_id, assignments in self.assignments.items():
+                for assignment in assignments:
+                    if assignment['AssignmentStatus'] == 'Submitted':
+                        assignment['AssignmentStatus'] = status
+                        self.hits[hit_id]['NumberOfAssignmentsCompleted'] += 1
+                        num_reviewed += 1
+        return num_reviewed
+
+
+class FakePaginator:
+
+    def __init__(self, method: Any):
+        self.method = method
+
+    def paginate(self, PaginationConfig: Optional[Dict[str, Any]] = None,
+                 **kwargs: Any) -> Iterator[Dict[str, Any]]:
+        page_size = (PaginationConfig or {}).get('PageSize', 10)
+        token = None
+        while True:
+            extra = {} if token is None else {'NextToken': token}
+            page = self.method(MaxResults=page_size, **kwargs, **extra)
+            yield page
+            token = page.get('NextToken')
+            if not token:
+                return
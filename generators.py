@@ -1,42 +1,31 @@
 from typing import Any, Union, Callable
 from pathlib import Path
-import json
 import csv
-from aws import list_bucket_objects
 from config import get_config
+from manifest import DatasetManifest, select
 
 
-def step_by_step_generator(client=None) -> Any:
+def step_by_step_generator(client=None, shard: int = 0, num_shards: int = 1) -> Any:
     """ A sample generator for the step by step experiment """
 
     config = get_config()
-    dataset_folder = Path(config['dataset_folder'])
+    manifest = DatasetManifest(config['dataset_folder'])
     s3_url = f"https://{config['bucket-name']}.s3.amazonaws.com/"
 
-    if not dataset_folder.is_dir():
-        raise ValueError(f"{dataset_folder} is not a folder")
+    for pair in manifest.pairs(shard, num_shards):
+        before = s3_url + pair['first']
+        after = s3_url + pair['last']
+        yield {'before': before, 'after': after, 'id': pair['id']}
 
-    for first_name in dataset_folder.glob("*_first.jpg"):
-        first_name = str(first_name.name)
-        last_name = first_name[:-len("_first.jpg")] + "_last.jpg"
-        num_simu = first_name.split("_")[-2]
-        before = s3_url + first_name
-        after = s3_url + last_name
-        yield {'before': before, 'after': after, 'id': num_simu}
 
-
-def check_generator(client) -> Any:
+def check_generator(client, shard: int = 0, num_shards: int = 1) -> Any:
     """ A sample generator for the check experiment """
 
     config = get_config()
-    dataset_folder = Path(config['dataset_folder'])
+    manifest = DatasetManifest(config['dataset_folder'])
     s3_url = f"https://{config['bucket-name']}.s3.amazonaws.com/"
-    annotation_file = Path(config['dataset_folder']) / "annotations.json"
-
-    with open(annotation_file, 'r') as fid:
-        annotations = json.load(fid)
 
-    for annotation in annotations:
+    for annotation in manifest.annotations(shard, num_shards):
         image = s3_url + "tower_" + annotation['num_cubes'] + "_" + \
                 annotation['id'] + "_first.jpg"
         yield {'instruction': annotation['instruction'],
@@ -44,30 +33,25 @@ def check_generator(client) -> Any:
                'image': image}
 
 
-def description_generator(client) -> Any:
+def description_generator(client, shard: int = 0, num_shards: int = 1) -> Any:
     """ A sample generator for the description experiment """
 
     config = get_config()
-    dataset_folder = Path(config['dataset_folder'])
+    manifest = DatasetManifest(config['dataset_folder'])
     s3_url = f"https://{config['bucket-name']}.s3.amazonaws.com/"
 
-    if not dataset_folder.is_dir():
-        raise ValueError(f"{dataset_folder} is not a folder")
-
-    for last_name in dataset_folder.glob("*_last.jpg"):
-        last_name = str(last_name.name)
-        num_simu = last_name.split("_")[-2]
-        after = s3_url + last_name
-        yield {'image': after, 'id': num_simu}
+    for image in manifest.lasts(shard, num_shards):
+        after = s3_url + image['last']
+        yield {'image': after, 'id': image['id']}
 
 
 def csv_generator(client, filename: Union[str, Path],
-                  delimiter=";") -> Any:
+                  delimiter=";", shard: int = 0, num_shards: int = 1) -> Any:
 
     with open(filename, "r", newline="") as fid:
         reader = csv.reader(fid, delimiter=delimiter)
         header = next(reader)
-        for row in reader:
+        for row in select(reader, shard, num_shards):
             yield {key: value for key, value in zip(header, row)}
 
 
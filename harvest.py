@@ -0,0 +1,156 @@
+from typing import Any, Dict, Iterator, List, Optional, Union
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+import csv
+import json
+import logging
+import os
+from botocore.exceptions import ClientError
+from tqdm.auto import tqdm
+from answers import parse_answers
+from inventory import get_inventory
+from records import StateJournal
+from throttle import TokenBucket, call_with_backoff
+
+
+COMPLETED_STATUSES = ['Submitted', 'Approved', 'Rejected']
+
+CSV_FIELDS = ['hit_id', 'task_name', 'assignment_id', 'worker_id',
+              'status', 'submit_time', 'answer']
+
+
+def iter_assignments(client: Any, hit_id: str,
+                     bucket: Optional[TokenBucket] = None
+                     ) -> Iterator[Dict[str, Any]]:
+    """ Stream all completed assignments of a HIT, page by page """
+    kwargs: Dict[str, Any] = {'HITId': hit_id,
+                              'MaxResults': 100,
+                              'AssignmentStatuses': COMPLETED_STATUSES}
+    while True:
+        response = call_with_backoff(client.list_assignments_for_hit,
+                                     bucket=bucket, **kwargs)
+        yield from response['Assignments']
+
+        token = response.get('NextToken')
+        if not token:
+            return
+        kwargs['NextToken'] = token
+
+
+def assignment_row(job: Dict[str, Any], assignment: Dict[str, Any]) -> Dict[str, Any]:
+    return {'hit_id': assignment['HITId'],
+            'task_name': job.get('task_name'),
+            'assignment_id': assignment['AssignmentId'],
+            'worker_id': assignment['WorkerId'],
+            'status': assignment['AssignmentStatus'],
+            'submit_time': str(assignment.get('SubmitTime', '')),
+            'answers': parse_answers(assignment['Answer'])}
+
+
+class ResultWriter:
+    """ Append harvested assignments to a JSONL or a CSV file """
+
+    def __init__(self, filename: Union[Path, str]):
+        self.filename = Path(filename)
+        self.is_csv = self.filename.suffix == '.csv'
+        is_new = not self.filename.is_file() or self.filename.stat().st_size == 0
+        self.fid = open(self.filename, 'a', newline='')
+        if self.is_csv:
+            self.writer = csv.DictWriter(self.fid, fieldnames=CSV_FIELDS)
+            if is_new:
+                self.writer.writeheader()
+
+    def write(self, row: Dict[str, Any]) -> None:
+        if self.is_csv:
+            answers = row['answers']
+            answer = next(iter(answers.values())) if len(answers) == 1 \
+                else answers
+            if not isinstance(answer, str):
+                answer = json.dumps(answer)
+            self.writer.writerow({**{k: row[k] for k in CSV_FIELDS[:-1]},
+                                  'answer': answer})
+        else:
+            self.fid.write(json.dumps(row) + '\n')
+
+    def flush(self) -> None:
+        self.fid.flush()
+        os.fsync(self.fid.fileno())
+
+    def close(self) -> None:
+        self.fid.close()
+
+
+def get_harvest_journal(output: Union[Path, str]) -> StateJournal:
+    """ The harvested assignments go with the output file they describe """
+    return StateJournal(str(output) + '.state.jsonl')
+
+
+def harvest(client: Any,
+            jobs: List[Dict[str, Any]],
+            output: Union[Path, str],
+            workers: int = 16,
+            rate: float = 10.) -> int:
+    """ Fetch the new assignments of the jobs and append them to output
+
+    The journal keeps, per HIT, the assignment IDs already written. Only
+    the HITs with more completed assignments than that, according to a
+    list_hits sync of the inventory, are queried. HITs missing from the
+    inventory are queried until all their assignments are harvested.
+    Return the number of new assignments.
+    """
+    journal = get_harvest_journal(output)
+    bucket = TokenBucket(rate, burst=workers)
+    inventory = get_inventory()
+    inventory.sync(client)
+    # (submitted, total) per HIT, counting the Submitted, Approved and
+    # Rejected assignments like COMPLETED_STATUSES
+    progress = inventory.progress([job['HITId'] for job in jobs])
+
+    def harvested(job: Dict[str, Any]) -> List[str]:
+        entry = journal.states.get(job['HITId'])
+        return [] if entry is None else entry['assignments']
+
+    def has_new(job: Dict[str, Any]) -> bool:
+        submitted = progress[job['HITId']][0] if job['HITId'] in progress \
+            else int(job.get('MaxAssignments', 1 << 30))
+        return len(harvested(job)) < submitted
+
+    todo = [job for job in jobs if has_new(job)]
+    logging.info(f"{len(jobs) - len(todo)} HITs have no new assignments, "
+                 f"querying {len(todo)} HITs")
+
+    def fetch(job: Dict[str, Any]) -> List[Dict[str, Any]]:
+        done = set(harvested(job))
+        return [assignment_row(job, assignment)
+                for assignment in iter_assignments(client, job['HITId'], bucket)
+                if assignment['AssignmentId'] not in done]
+
+    writer = ResultWriter(output)
+    num_new = 0
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(fetch, job): job for job in todo}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                job = futures[future]
+                try:
+                    rows = future.result()
+                except ClientError as err:
+                    logging.error(f"Can't harvest {job['HITId']}: {err}")
+                    continue
+                if not rows:
+                    continue
+
+                for row in rows:
+                    writer.write(row)
+                writer.flush()
+
+                # Results are written before the journal moves
+                journal.append(job['HITId'], 'harvested',
+                               assignments=harvested(job)
+                               + [row['assignment_id'] for row in rows])
+                num_new += len(rows)
+    finally:
+        writer.close()
+
+    logging.info(f"Harvested {num_new} new assignments into {output}")
+    return num_new
@@ -0,0 +1,109 @@
+from typing import Any, Dict, Union
+from pathlib import Path
+import hashlib
+import json
+import logging
+import os
+import threading
+from config import get_config, thaw
+from throttle import call_with_backoff
+
+
+# Parameters shared by all the HITs of a HIT type
+HIT_TYPE_FIELDS = ('title', 'description', 'keywords', 'reward',
+                   'assignment_duration', 'auto_approval_delay')
+
+# Parameters given to each HIT
+HIT_FIELDS = ('max_assignments', 'lifetime', 'template')
+
+
+def validate_task(task: Dict[str, Any]) -> None:
+    """ Check the task parameters before anything is sent to MTurk """
+    missing = [key for key in ('name',) + HIT_TYPE_FIELDS + HIT_FIELDS
+               if key not in task]
+    if missing:
+        raise ValueError(f"Task {task.get('name')} misses {', '.join(missing)}")
+
+    if float(task['reward']) <= 0:
+        raise ValueError(f"Task {task['name']} has no reward")
+
+    for key in ('assignment_duration', 'auto_approval_delay',
+                'max_assignments', 'lifetime'):
+        try:
+            int(task[key])
+        except (TypeError, ValueError):
+            raise ValueError(f"Task {task['name']}: {key} must be an integer, "
+                             f"not {task[key]!r}")
+
+
+def hit_type_key(task: Dict[str, Any]) -> str:
+    """ Hash of the HIT type parameters. HIT types differ between endpoints """
+    params = {key: thaw(task[key]) for key in HIT_TYPE_FIELDS}
+    params['endpoint_url'] = get_config('mturk')['endpoint_url']
+    payload = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def create_hit_type(client: Any, task: Dict[str, Any]) -> Dict[str, Any]:
+    return client.create_hit_type(Title=task['title'],
+                                  Description=task['description'],
+                                  Keywords=task['keywords'],
+                                  Reward=str(task['reward']),
+                                  AssignmentDurationInSeconds=int(task['assignment_duration']),
+                                  AutoApprovalDelayInSeconds=int(task['auto_approval_delay']))
+
+
+class HitTypeRegistry:
+    """ Persisted map from the hash of a task's HIT type parameters to its HITTypeId
+
+    A task is validated the first time it is seen in a run.
+    """
+
+    def __init__(self, filename: Union[Path, str]):
+        self.filename = Path(filename)
+        self.hit_types: Dict[str, Dict[str, str]] = {}
+        if self.filename.is_file():
+            with open(self.filename, 'r') as fid:
+                self.hit_types = json.load(fid)
+        self._validated: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def get(self, client: Any, task: Dict[str, Any]) -> str:
+        """ Return the HITTypeId of the task, creating the HIT type if needed """
+        hit_type_id = self._validated.get(task['name'])
+        if hit_type_id is not None:
+            return hit_type_id
+
+        with self._lock:
+            if task['name'] in self._validated:
+                return self._validated[task['name']]
+
+            validate_task(task)
+            key = hit_type_key(task)
+            if key not in self.hit_types:
+                response = call_with_backoff(create_hit_type, client, task)
+                self.hit_types[key] = {'HITTypeId': response['HITTypeId'],
+                                       'task_name': task['name']}
+                self._save()
+                logging.info(f"Created the HIT type {response['HITTypeId']} "
+                             f"for {task['name']}")
+
+            self._validated[task['name']] = self.hit_types[key]['HITTypeId']
+            return self._validated[task['name']]
+
+    def _save(self) -> None:
+        tmp_file = self.filename.with_name(self.filename.name + '.tmp')
+        with open(tmp_file, 'w') as fid:
+            json.dump(self.hit_types, fid, indent=2)
+        os.replace(tmp_file, self.filename)
+
+
+_registry = None
+
+
+def get_hit_type_registry() -> HitTypeRegistry:
+    global _registry
+    if _registry is None:
+        _registry = HitTypeRegistry(get_config().get('hit_type_filename',
+                                                     'hit_types.json'))
+    return _registry
@@ -0,0 +1,160 @@
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+from pathlib import Path
+import logging
+import sqlite3
+import threading
+import time
+from config import get_config
+from throttle import call_with_backoff
+
+
+# HITs that workers can still accept or are working on
+LIVE_STATUSES = ('Assignable', 'Unassignable')
+
+
+def iter_hits(client: Any, page_size: int = 100) -> Iterator[Dict[str, Any]]:
+    """ Stream all HITs of the account, page by page; a throttled page is retried """
+    kwargs: Dict[str, Any] = {'MaxResults': page_size}
+    while True:
+        response = call_with_backoff(client.list_hits, **kwargs)
+        yield from response['HITs']
+
+        token = response.get('NextToken')
+        if not token:
+            return
+        kwargs['NextToken'] = token
+
+
+def _row(hit: Dict[str, Any]) -> Tuple:
+    return (hit['HITId'],
+            hit.get('HITTypeId'),
+            hit['HITStatus'],
+            int(hit['MaxAssignments']),
+            int(hit.get('NumberOfAssignmentsPending', 0)),
+            int(hit.get('NumberOfAssignmentsAvailable', 0)),
+            int(hit.get('NumberOfAssignmentsCompleted', 0)),
+            str(hit.get('CreationTime', '')),
+            str(hit.get('Expiration', '')))
+
+
+class HitInventory:
+    """ Local SQLite copy of the HITs of the account
+
+    MTurk counts an assignment as completed once it is approved or
+    rejected, so a submitted assignment is one that is neither
+    available nor pending.
+    """
+
+    def __init__(self, filename: Union[Path, str]):
+        self.filename = Path(filename)
+        self.db = sqlite3.connect(str(self.filename), check_same_thread=False)
+        self._lock = threading.RLock()
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS hits (
+                hit_id TEXT PRIMARY KEY,
+                hit_type_id TEXT,
+                status TEXT,
+                max_assignments INTEGER,
+                pending INTEGER,
+                available INTEGER,
+                completed INTEGER,
+                creation_time TEXT,
+                expiration TEXT,
+                synced_at REAL
+            )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS hits_status ON hits (status)")
+        self.db.commit()
+
+    def sync(self, client: Any) -> Dict[str, int]:
+        """ Refresh the inventory from list_hits. Only changed HITs are written """
+        with self._lock:
+            known = {row[0]: row for row in self.db.execute(
+                "SELECT hit_id, hit_type_id, status, max_assignments, pending, "
+                "available, completed, creation_time, expiration FROM hits")}
+        seen = set()
+        changed: List[Tuple] = []
+        now = time.time()
+
+        for hit in iter_hits(client):
+            row = _row(hit)
+            seen.add(row[0])
+            if known.get(row[0]) != row:
+                changed.append(row + (now,))
+
+        gone = [(hit_id,) for hit_id in known if hit_id not in seen]
+        num_new = sum(1 for row in changed if row[0] not in known)
+
+        with self._lock, self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO hits VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                changed)
+            self.db.executemany("DELETE FROM hits WHERE hit_id = ?", gone)
+
+        stats = {'new': num_new, 'updated': len(changed) - num_new,
+                 'deleted': len(gone), 'total': len(seen)}
+        logging.info(f"Inventory synced: {stats}")
+        return stats
+
+    def update(self, hit: Dict[str, Any]) -> None:
+        """ Store a single HIT, e.g. after a get_hit """
+        with self._lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO hits VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                _row(hit) + (time.time(),))
+
+    def remove(self, hit_id: str) -> None:
+        with self._lock, self.db:
+            self.db.execute("DELETE FROM hits WHERE hit_id = ?", (hit_id,))
+
+    def hit_ids(self, status: Optional[str] = None) -> List[str]:
+        with self._lock:
+            if status is None:
+                rows = self.db.execute("SELECT hit_id FROM hits")
+            else:
+                rows = self.db.execute("SELECT hit_id FROM hits WHERE status = ?",
+                                       (status,))
+            return [row[0] for row in rows]
+
+    def status(self, hit_id: str) -> Optional[str]:
+        with self._lock:
+            row = self.db.execute("SELECT status FROM hits WHERE hit_id = ?",
+                                  (hit_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def count_live(self, hit_type_id: Optional[str] = None) -> int:
+        """ Number of live HITs, optionally of a single HIT type """
+        query = "SELECT COUNT(*) FROM hits WHERE status IN (?, ?)"
+        params: Tuple = LIVE_STATUSES
+        if hit_type_id is not None:
+            query += " AND hit_type_id = ?"
+            params += (hit_type_id,)
+        with self._lock:
+            return self.db.execute(query, params).fetchone()[0]
+
+    def count_by_status(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.db.execute(
+                "SELECT status, COUNT(*) FROM hits GROUP BY status"))
+
+    def progress(self, hit_ids: Optional[List[str]] = None
+                 ) -> Dict[str, Tuple[int, int]]:
+        """ (submitted, total) assignments per HIT, without any API call """
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT hit_id, max_assignments - available - pending, "
+                "max_assignments FROM hits")
+            progress = {row[0]: (row[1], row[2]) for row in rows}
+        if hit_ids is not None:
+            progress = {h: progress[h] for h in hit_ids if h in progress}
+        return progress
+
+
+_inventory: Optional[HitInventory] = None
+
+
+def get_inventory() -> HitInventory:
+    global _inventory
+    if _inventory is None:
+        _inventory = HitInventory(get_config().get('inventory_filename',
+                                                   'inventory.sqlite'))
+    return _inventory
@@ -0,0 +1,121 @@
+from typing import Any, Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import Counter
+from datetime import datetime
+import logging
+from botocore.exceptions import ClientError
+from tqdm.auto import tqdm
+from config import get_config
+from inventory import get_inventory
+from records import StateJournal
+from throttle import TokenBucket, call_with_backoff, error_code
+
+
+EXPIRED = 'expired'
+DELETED = 'deleted'
+WAITING = 'waiting'
+FAILED = 'failed'
+
+# MTurk only tells the errors apart by their message
+NOT_FOUND = ('does not exist',)
+NOT_READY = ('currently in the state', 'status of', 'not active', 'not reviewable')
+
+
+def hit_error(err: ClientError) -> Optional[str]:
+    """ DELETED for a HIT that doesn't exist, WAITING for one in the wrong
+    state, None for anything else """
+    message = str(err).lower()
+    if any(marker in message for marker in NOT_FOUND):
+        return DELETED
+    if any(marker in message for marker in NOT_READY):
+        return WAITING
+    return None
+
+
+def get_lifecycle_journal() -> StateJournal:
+    return StateJournal(get_config().get('lifecycle_journal', 'lifecycle.jsonl'))
+
+
+def expire_hit(client: Any, hit_id: str, bucket: Optional[TokenBucket] = None) -> str:
+    """ Set the HIT to expire immediately, so no worker can accept it """
+    try:
+        call_with_backoff(client.update_expiration_for_hit,
+                          HITId=hit_id,
+                          ExpireAt=datetime(2015, 1, 1),
+                          bucket=bucket)
+    except ClientError as err:
+        state = hit_error(err)
+        if state is None:
+            logging.error(f"Can't expire {hit_id}: {err}")
+            return FAILED
+        if state == DELETED:
+            logging.info(f"{hit_id} was already deleted")
+            return DELETED
+        # Already expired or reviewable: no worker can accept it anyway
+        logging.debug(f"{hit_id} is not active: {error_code(err)}")
+    return EXPIRED
+
+
+def try_delete_hit(client: Any, hit_id: str, bucket: Optional[TokenBucket] = None) -> str:
+    """ Delete the HIT if it is reviewable. Otherwise it is left for a later run """
+    try:
+        call_with_backoff(client.delete_hit, HITId=hit_id, bucket=bucket)
+    except ClientError as err:
+        state = hit_error(err)
+        if state is None:
+            logging.error(f"Can't delete {hit_id}: {err}")
+            return FAILED
+        if state == DELETED:
+            logging.info(f"{hit_id} was already deleted")
+        else:
+            # Assignments are still pending or waiting for review
+            logging.debug(f"Can't delete {hit_id} yet: {error_code(err)}")
+        return state
+    return DELETED
+
+
+def process_hits(client: Any,
+                 hit_ids: List[str],
+                 expire: bool = True,
+                 delete: bool = True,
+                 workers: int = 16,
+                 rate: float = 10.) -> Dict[str, int]:
+    """ Expire and/or delete HITs concurrently
+
+    Each HIT gets one expiration call and one deletion attempt at most.
+    HITs that are not reviewable yet are reported as waiting, and the
+    journal lets a later run skip the HITs already handled.
+    """
+    journal = get_lifecycle_journal()
+    inventory = get_inventory()
+    bucket = TokenBucket(rate, burst=workers)
+    todo = [hit_id for hit_id in hit_ids if journal.state(hit_id) != DELETED]
+
+    def process(hit_id: str) -> str:
+        state = journal.state(hit_id)
+        if expire and state != EXPIRED:
+            state = expire_hit(client, hit_id, bucket)
+            if state == EXPIRED:
+                journal.append(hit_id, EXPIRED)
+        if delete and state != DELETED:
+            state = try_delete_hit(client, hit_id, bucket)
+        if state == DELETED:
+            journal.append(hit_id, DELETED)
+            inventory.remove(hit_id)
+        return state
+
+    counts: Counter = Counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process, hit_id): hit_id for hit_id in todo}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            try:
+                counts[future.result()] += 1
+            except Exception as err:
+                logging.error(f"Can't process {futures[future]}: {err}")
+                counts[FAILED] += 1
+
+    logging.info(f"Skipped {len(hit_ids) - len(todo)} HITs already deleted")
+    logging.info(f"Processed {len(todo)} HITs: {dict(counts)}")
+    if counts[WAITING] > 0:
+        logging.info(f"Run again once the {counts[WAITING]} waiting HITs are reviewable")
+    return dict(counts)
@@ -0,0 +1,185 @@
+from typing import Any, Dict, Iterator, List, Optional, Union
+from itertools import islice
+from pathlib import Path
+import codecs
+import json
+import logging
+import os
+
+
+MANIFEST_FOLDER = ".manifest"
+MANIFEST_NAME = "manifest.json"
+FIRST_SUFFIX = "_first.jpg"
+LAST_SUFFIX = "_last.jpg"
+
+# Bytes of annotations.json decoded at once while scanning it
+BLOCK_SIZE = 1 << 20
+
+
+def _scan_images(dataset_folder: Path) -> List[List[Any]]:
+    """ [stem, id, has_first, has_last] for every rendered tower, sorted by stem """
+    images: Dict[str, List[Any]] = {}
+    with os.scandir(dataset_folder) as entries:
+        for entry in entries:
+            name = entry.name
+            if name.endswith(FIRST_SUFFIX):
+                stem, index = name[:-len(FIRST_SUFFIX)], 2
+            elif name.endswith(LAST_SUFFIX):
+                stem, index = name[:-len(LAST_SUFFIX)], 3
+            else:
+                continue
+            if stem not in images:
+                images[stem] = [stem, stem.split("_")[-1], False, False]
+            images[stem][index] = True
+    return [images[stem] for stem in sorted(images)]
+
+
+def _scan_offsets(annotation_file: Path) -> List[List[int]]:
+    """ Byte spans of the items of a JSON array, so each one can be read alone
+
+    The file is decoded block by block, and the byte length of each item
+    comes from encoding that item only.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    offsets = []
+    # `offset` is the position in the file of buffer[pos]
+    buffer, pos, offset = '', 0, 0
+    separators = ' \t\r\n'
+    started = eof = False
+
+    with open(annotation_file, 'rb') as fid:
+        def read() -> bool:
+            nonlocal buffer, pos
+            block = fid.read(BLOCK_SIZE)
+            buffer = buffer[pos:] + utf8.decode(block, final=not block)
+            pos = 0
+            return bool(block)
+
+        while True:
+            # Separators are ASCII, one byte each
+            skipped = pos
+            while pos < len(buffer) and buffer[pos] in separators:
+                pos += 1
+            offset += pos - skipped
+            if pos == len(buffer):
+                if eof:
+                    raise ValueError(f"{annotation_file} is not a complete JSON array")
+                eof = not read()
+                continue
+
+            if not started:
+                if buffer[pos] != '[':
+                    raise ValueError(f"{annotation_file} is not a JSON array")
+                started = True
+                separators += ','
+                pos += 1
+                offset += 1
+                continue
+            if buffer[pos] == ']':
+                break
+
+            try:
+                _, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                end = None
+            # A number cut by the end of the block decodes, but isn't followed
+            # by a separator
+            if end is None or end == len(buffer) or buffer[end] not in ' \t\r\n,]':
+                if eof:
+                    raise ValueError(f"{annotation_file} is not a JSON array")
+                eof = not read()
+                continue
+
+            size = len(buffer[pos:end].encode('utf-8'))
+            offsets.append([offset, offset + size])
+            offset += size
+            pos = end
+    return offsets
+
+
+class DatasetManifest:
+    """ Listing of a dataset folder, stored next to the data
+
+    The image listing is rebuilt only when the folder mtime changes, and
+    the annotation offsets only when annotations.json changes.
+    """
+
+    def __init__(self, dataset_folder: Union[Path, str]):
+        self.dataset_folder = Path(dataset_folder)
+        if not self.dataset_folder.is_dir():
+            raise ValueError(f"{self.dataset_folder} is not a folder")
+
+        # In a subfolder, so that writing it does not change the folder mtime
+        manifest_folder = self.dataset_folder / MANIFEST_FOLDER
+        manifest_folder.mkdir(exist_ok=True)
+        self.filename = manifest_folder / MANIFEST_NAME
+        self.annotation_file = self.dataset_folder / "annotations.json"
+        self.data: Dict[str, Any] = {}
+        if self.filename.is_file():
+            with open(self.filename, 'r') as fid:
+                self.data = json.load(fid)
+        self.refresh()
+
+    def refresh(self) -> None:
+        changed = False
+
+        folder_mtime = self.dataset_folder.stat().st_mtime_ns
+        if self.data.get('folder_mtime') != folder_mtime:
+            logging.info(f"Scanning {self.dataset_folder}")
+            self.data['images'] = _scan_images(self.dataset_folder)
+            self.data['folder_mtime'] = folder_mtime
+            changed = True
+
+        if self.annotation_file.is_file():
+            annotation_mtime = self.annotation_file.stat().st_mtime_ns
+            if self.data.get('annotation_mtime') != annotation_mtime:
+                self.data['offsets'] = _scan_offsets(self.annotation_file)
+                self.data['annotation_mtime'] = annotation_mtime
+                changed = True
+
+        if changed:
+            tmp_file = self.filename.with_name(MANIFEST_NAME + ".tmp")
+            with open(tmp_file, 'w') as fid:
+                json.dump(self.data, fid)
+            os.replace(tmp_file, self.filename)
+
+    def pairs(self, shard: int = 0, num_shards: int = 1,
+              start: Optional[int] = None,
+              stop: Optional[int] = None) -> Iterator[Dict[str, str]]:
+        """ (first, last, id) of the towers that have a first image """
+        images = (image for image in self.data['images'] if image[2])
+        for stem, num_simu, _, _ in select(images, shard, num_shards, start, stop):
+            yield {'first': stem + FIRST_SUFFIX,
+                   'last': stem + LAST_SUFFIX,
+                   'id': num_simu}
+
+    def lasts(self, shard: int = 0, num_shards: int = 1,
+              start: Optional[int] = None,
+              stop: Optional[int] = None) -> Iterator[Dict[str, str]]:
+        """ (last, id) of the towers that have a last image """
+        images = (image for image in self.data['images'] if image[3])
+        for stem, num_simu, _, _ in select(images, shard, num_shards, start, stop):
+            yield {'last': stem + LAST_SUFFIX, 'id': num_simu}
+
+    def annotations(self, shard: int = 0, num_shards: int = 1,
+                    start: Optional[int] = None,
+                    stop: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        """ Read the selected annotations one by one from annotations.json """
+        offsets = select(self.data.get('offsets', []), shard, num_shards, start, stop)
+        with open(self.annotation_file, 'rb') as fid:
+            for begin, end in offsets:
+                fid.seek(begin)
+                yield json.loads(fid.read(end - begin))
+
+
+def select(items: Iterator[Any], shard: int = 0, num_shards: int = 1,
+           start: Optional[int] = None,
+           stop: Optional[int] = None) -> Iterator[Any]:
+    """ Slice the items, then keep one shard out of num_shards """
+    if not 0 <= shard < num_shards:
+        raise ValueError(f"Shard {shard} is not in [0, {num_shards})")
+    sliced = islice(items, start, stop)
+    return islice(sliced, shard, None, num_shards)
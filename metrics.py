@@ -0,0 +1,165 @@
+from typing import Any, Dict, List, Tuple, Union
+from collections import defaultdict
+from pathlib import Path
+import bisect
+import json
+import threading
+import time
+from throttle import THROTTLING_CODES
+
+
+# Upper bounds (in seconds) of the latency histogram buckets
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30.)
+
+
+class OperationStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.attempts = 0
+        # Retries made above botocore, see ApiMetrics.record_retry
+        self.backoff_retries = 0
+        self.throttles = 0
+        self.latency_sum = 0.
+        self.histogram = [0] * (len(BUCKETS) + 1)
+
+    @property
+    def retries(self) -> int:
+        return max(0, self.attempts - self.calls) + self.backoff_retries
+
+    def observe(self, seconds: float) -> None:
+        self.latency_sum += seconds
+        self.histogram[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {'calls': self.calls,
+                'errors': self.errors,
+                'retries': self.retries,
+                'throttles': self.throttles,
+                'latency_sum': self.latency_sum,
+                'latency_mean': self.latency_sum / self.calls if self.calls else 0.,
+                'latency_buckets': dict(zip([str(b) for b in BUCKETS] + ['+Inf'],
+                                            self.histogram))}
+
+
+class ApiMetrics:
+    """ Per-operation counters fed by the botocore event system
+
+    before-call/after-call give one latency per API call, including the
+    retries botocore makes. response-received fires once per HTTP attempt,
+    which gives the retries and the throttled responses. Retries made by
+    throttle.call_with_backoff are new calls to botocore, so it reports them
+    with record_retry.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats: Dict[Tuple[str, str], OperationStats] = defaultdict(OperationStats)
+        # Operation of the last call of each thread
+        self._local = threading.local()
+
+    def attach(self, client: Any) -> None:
+        events = client.meta.events
+        events.register('before-call', self._before_call)
+        events.register('after-call', self._after_call)
+        events.register('after-call-error', self._after_call_error)
+        events.register('response-received', self._response_received)
+
+    def _before_call(self, model: Any, context: Dict[str, Any], **kwargs: Any) -> None:
+        # Later events only get the context, so the operation is kept there
+        context['metrics_key'] = (model.service_model.service_name, model.name)
+        context['metrics_start'] = time.perf_counter()
+        self._local.key = context['metrics_key']
+
+    def record_retry(self) -> None:
+        """ Count a retry of the last call of this thread """
+        key = getattr(self._local, 'key', None)
+        if key is None:
+            return
+        with self._lock:
+            self.stats[key].backoff_retries += 1
+
+    def _finish(self, context: Dict[str, Any], error: bool) -> None:
+        if 'metrics_key' not in context:
+            return
+        elapsed = time.perf_counter() - context['metrics_start']
+        with self._lock:
+            stats = self.stats[context['metrics_key']]
+            stats.calls += 1
+            stats.errors += int(error)
+            stats.observe(elapsed)
+
+    def _after_call(self, context: Dict[str, Any], http_response: Any = None,
+                    **kwargs: Any) -> None:
+        status = getattr(http_response, 'status_code', 200)
+        self._finish(context, error=status >= 300)
+
+    def _after_call_error(self, context: Dict[str, Any], **kwargs: Any) -> None:
+        self._finish(context, error=True)
+
+    def _response_received(self, context: Dict[str, Any],
+                           parsed_response: Any = None, **kwargs: Any) -> None:
+        if 'metrics_key' not in context:
+            return
+        code = (parsed_response or {}).get('Error', {}).get('Code', '')
+        with self._lock:
+            stats = self.stats[context['metrics_key']]
+            stats.attempts += 1
+            stats.throttles += int(code in THROTTLING_CODES)
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {f"{service}.{operation}": stats.as_dict()
+                    for (service, operation), stats in sorted(self.stats.items())}
+
+    def to_prometheus(self) -> str:
+        """ Metrics in the Prometheus text exposition format """
+        lines: List[str] = []
+
+        def family(name: str, kind: str, help_text: str) -> None:
+            lines.append(f"# HELP nalanbot_api_{name} {help_text}")
+            lines.append(f"# TYPE nalanbot_api_{name} {kind}")
+
+        with self._lock:
+            items = sorted(self.stats.items())
+
+            for name, attribute, help_text in (
+                    ('calls_total', 'calls', 'AWS API calls'),
+                    ('errors_total', 'errors', 'AWS API calls that failed'),
+                    ('retries_total', 'retries', 'Retried HTTP attempts'),
+                    ('throttles_total', 'throttles', 'Throttled HTTP attempts')):
+                family(name, 'counter', help_text)
+                for (service, operation), stats in items:
+                    labels = f'service="{service}",operation="{operation}"'
+                    lines.append(f"nalanbot_api_{name}{{{labels}}} {getattr(stats, attribute)}")
+
+            family('latency_seconds', 'histogram', 'AWS API call latency')
+            for (service, operation), stats in items:
+                labels = f'service="{service}",operation="{operation}"'
+                cumulative = 0
+                for bound, count in zip([str(b) for b in BUCKETS] + ['+Inf'],
+                                        stats.histogram):
+                    cumulative += count
+                    lines.append(f'nalanbot_api_latency_seconds_bucket{{{labels},le="{bound}"}} '
+                                 f'{cumulative}')
+                lines.append(f"nalanbot_api_latency_seconds_sum{{{labels}}} {stats.latency_sum}")
+                lines.append(f"nalanbot_api_latency_seconds_count{{{labels}}} {stats.calls}")
+
+        return "\n".join(lines) + "\n"
+
+    def dump(self, filename: Union[Path, str]) -> None:
+        """ Write a Prometheus textfile for *.prom, JSON otherwise """
+        filename = Path(filename)
+        content = self.to_prometheus() if filename.suffix == '.prom' \
+            else json.dumps(self.as_dict(), indent=2)
+        tmp_file = filename.with_name(filename.name + '.tmp')
+        with open(tmp_file, 'w') as fid:
+            fid.write(content)
+        tmp_file.replace(filename)
+
+
+_metrics = ApiMetrics()
+
+
+def get_metrics() -> ApiMetrics:
+    return _metrics
@@ -0,0 +1,277 @@
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from collections import deque
+import itertools
+import json
+import logging
+import threading
+import time
+from botocore.exceptions import ClientError
+from config import get_config
+from inventory import get_inventory
+from throttle import call_with_backoff
+
+
+EVENT_TYPES = ('AssignmentSubmitted', 'HITReviewable', 'HITExpired')
+
+NOTIFICATION_VERSION = '2014-08-15'
+
+# Shortest long poll, so a loop close to its reconciliation doesn't spin on SQS
+MIN_WAIT = 1
+
+
+def register_notifications(client: Any, hit_type_id: str, destination: str) -> str:
+    """ Send the events of a HIT type to an SQS queue (by ARN) """
+    call_with_backoff(client.update_notification_settings,
+                      HITTypeId=hit_type_id,
+                      Notification={'Destination': destination,
+                                    'Transport': 'SQS',
+                                    'Version': NOTIFICATION_VERSION,
+                                    'EventTypes': list(EVENT_TYPES)},
+                      Active=True)
+    logging.info(f"Notifications of {hit_type_id} go to {destination}")
+    return hit_type_id
+
+
+class LocalQueue:
+    """ In-memory stand-in for the SQS calls used here
+
+    Received messages stay in flight until deleted, and come back after
+    `visibility_timeout` seconds otherwise, like SQS.
+    """
+
+    def __init__(self, visibility_timeout: float = 30.):
+        self.visibility_timeout = visibility_timeout
+        self._messages: deque = deque()
+        self._in_flight: Dict[str, Tuple[float, str]] = {}
+        self._handles = itertools.count()
+        self._condition = threading.Condition()
+
+    def send_message(self, MessageBody: str, QueueUrl: Optional[str] = None) -> Dict[str, Any]:
+        with self._condition:
+            self._messages.append(MessageBody)
+            self._condition.notify()
+        return {}
+
+    def _requeue_expired(self) -> None:
+        now = time.monotonic()
+        for handle, (deadline, body) in list(self._in_flight.items()):
+            if deadline <= now:
+                del self._in_flight[handle]
+                self._messages.append(body)
+
+    def receive_message(self, QueueUrl: Optional[str] = None,
+                        MaxNumberOfMessages: int = 1,
+                        WaitTimeSeconds: float = 0.,
+                        **kwargs: Any) -> Dict[str, Any]:
+        deadline = time.monotonic() + WaitTimeSeconds
+        with self._condition:
+            self._requeue_expired()
+            while not self._messages and time.monotonic() < deadline:
+                self._condition.wait(deadline - time.monotonic())
+                self._requeue_expired()
+
+            messages = []
+            while self._messages and len(messages) < MaxNumberOfMessages:
+                body = self._messages.popleft()
+                handle = str(next(self._handles))
+                self._in_flight[handle] = (time.monotonic() + self.visibility_timeout, body)
+                messages.append({'ReceiptHandle': handle, 'Body': body})
+        return {'Messages': messages} if messages else {}
+
+    def delete_message_batch(self, Entries: List[Dict[str, str]],
+                             QueueUrl: Optional[str] = None) -> Dict[str, Any]:
+        with self._condition:
+            for entry in Entries:
+                self._in_flight.pop(entry['ReceiptHandle'], None)
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries]}
+
+
+def parse_events(body: str) -> List[Dict[str, Any]]:
+    """ Events of an MTurk notification message; other messages are ignored """
+    try:
+        message = json.loads(body)
+    except ValueError:
+        logging.warning(f"Ignoring a message that is not JSON: {body[:80]}")
+        return []
+    return message.get('Events', []) if isinstance(message, dict) else []
+
+
+class LiveProgress:
+    """ Per-HIT counters, from listings and from the HITs named by events
+
+    An AssignmentSubmitted event only marks its HIT as stale: the counts are
+    re-fetched from MTurk, since a listing may already include the
+    assignment of a queued event. SQS delivers a message at least once, so
+    an AssignmentId marks its HIT once. Events of unwatched HITs are ignored.
+    """
+
+    def __init__(self, task_names: Dict[str, str]):
+        self.task_names = task_names
+        self.progress: Dict[str, List[int]] = {}
+        self.status: Dict[str, str] = {}
+        self.stale: set = set()
+        self._seen: set = set()
+
+    def reconcile(self, progress: Dict[str, Tuple[int, int]],
+                  status: Dict[str, Optional[str]]) -> None:
+        """ Replace the counters of the listed HITs """
+        for hit_id, counts in progress.items():
+            if hit_id in self.task_names:
+                self.progress[hit_id] = list(counts)
+        for hit_id, hit_status in status.items():
+            if hit_id in self.task_names and hit_status is not None:
+                self.status[hit_id] = hit_status
+
+    def apply(self, event: Dict[str, Any]) -> bool:
+        """ Update the status or mark the HIT as stale. Return True if the
+        status changed """
+        hit_id = event.get('HITId')
+        if hit_id not in self.task_names:
+            return False
+
+        event_type = event.get('EventType')
+        if event_type == 'AssignmentSubmitted':
+            if event.get('AssignmentId') not in self._seen:
+                self._seen.add(event.get('AssignmentId'))
+                self.stale.add(hit_id)
+            return False
+        elif event_type == 'HITReviewable':
+            self.status[hit_id] = 'Reviewable'
+        elif event_type == 'HITExpired':
+            self.status[hit_id] = 'Expired'
+        else:
+            return False
+        return True
+
+    def is_done(self) -> bool:
+        return all(self.status.get(hit_id) in ('Reviewable', 'Reviewing', 'Expired',
+                                               'Disposed')
+                   or (hit_id in self.progress
+                       and self.progress[hit_id][0] >= self.progress[hit_id][1] > 0)
+                   for hit_id in self.task_names)
+
+    def totals(self) -> Dict[str, List[int]]:
+        """ [submitted, total, done HITs, HITs] per task """
+        per_task: Dict[str, List[int]] = {}
+        for hit_id, task_name in self.task_names.items():
+            counts = per_task.setdefault(task_name or 'unknown', [0, 0, 0, 0])
+            completed, total = self.progress.get(hit_id, (0, 0))
+            counts[0] += completed
+            counts[1] += total
+            counts[2] += int(total > 0 and completed >= total)
+            counts[3] += 1
+        return per_task
+
+    def log(self) -> None:
+        for task_name, (completed, total, done, num_hits) in sorted(self.totals().items()):
+            logging.info(f"{task_name}: {completed}/{total} assignments, "
+                         f"{done}/{num_hits} HITs completed")
+
+
+def reconcile(client: Any, live: LiveProgress) -> None:
+    """ Full listing from list_hits, through the inventory """
+    inventory = get_inventory()
+    inventory.sync(client)
+    hit_ids = list(live.task_names)
+    live.reconcile(inventory.progress(hit_ids),
+                   {hit_id: inventory.status(hit_id) for hit_id in hit_ids})
+
+
+def refresh(client: Any, live: LiveProgress) -> int:
+    """ Re-fetch the stale HITs one by one, through the inventory """
+    inventory = get_inventory()
+    num_refreshed = 0
+    while live.stale:
+        hit_id = live.stale.pop()
+        try:
+            hit = call_with_backoff(client.get_hit, HITId=hit_id)['HIT']
+        except ClientError as err:
+            logging.warning(f"Can't refresh {hit_id}, left to the reconciliation: {err}")
+            continue
+        inventory.update(hit)
+        live.reconcile(inventory.progress([hit_id]), {hit_id: hit['HITStatus']})
+        num_refreshed += 1
+    return num_refreshed
+
+
+def drain(client: Any, sqs: Any, queue_url: str, live: LiveProgress,
+          wait: int = 20, max_messages: int = 10) -> int:
+    """ Apply the events of one batch of messages, then re-fetch the HITs
+    they name. Return the number of changes """
+    response = sqs.receive_message(QueueUrl=queue_url,
+                                   MaxNumberOfMessages=max_messages,
+                                   WaitTimeSeconds=wait)
+    messages = response.get('Messages', [])
+    num_changes = 0
+    for message in messages:
+        for event in parse_events(message['Body']):
+            num_changes += int(live.apply(event))
+    if messages:
+        sqs.delete_message_batch(QueueUrl=queue_url,
+                                 Entries=[{'Id': str(i), 'ReceiptHandle': m['ReceiptHandle']}
+                                          for i, m in enumerate(messages)])
+    return num_changes + refresh(client, live)
+
+
+def watch_progress(client: Any, sqs: Any, queue_url: str,
+                   task_names: Dict[str, str],
+                   reconcile_every: float = 300.,
+                   wait: int = 20,
+                   timeout: Optional[float] = None) -> LiveProgress:
+    """
+    Follow the HITs from their notification events until all are done.
+    A full reconciliation runs at start and every `reconcile_every` seconds,
+    in case events were lost or arrived for HITs listed later.
+    """
+    live = LiveProgress(task_names)
+    started_at = time.monotonic()
+    reconciled_at = started_at
+    reconcile(client, live)
+    live.log()
+
+    try:
+        while not live.is_done():
+            now = time.monotonic()
+            if timeout is not None and now - started_at > timeout:
+                logging.info("Watch timed out")
+                break
+            if now - reconciled_at > reconcile_every:
+                reconcile(client, live)
+                reconciled_at = now
+                live.log()
+            elif drain(client, sqs, queue_url, live,
+                       wait=max(MIN_WAIT, int(min(wait, reconcile_every - (now - reconciled_at))))):
+                live.log()
+    except KeyboardInterrupt:
+        logging.info("Watch interrupted")
+
+    live.log()
+    return live
+
+
+def get_queue_settings() -> Tuple[str, str]:
+    """ (queue URL, queue ARN) of the notification queue in the config """
+    sqs = get_config().get('sqs', {})
+    if not sqs.get('queue_url') or not sqs.get('queue_arn'):
+        raise ValueError("Set sqs.queue_url and sqs.queue_arn in the config to watch")
+    return sqs['queue_url'], sqs['queue_arn']
+
+
+def watch_tasks(client: Any, sqs: Any, jobs: Iterable[Dict[str, Any]],
+                reconcile_every: float = 300.,
+                timeout: Optional[float] = None) -> LiveProgress:
+    """ Register the HIT types of the jobs for notifications, then watch their HITs
+
+    The HIT types come from the recorded jobs: the config may describe a
+    task differently now, and its HIT type must not be created just to watch.
+    Jobs without a HITTypeId are only reconciled.
+    """
+    queue_url, queue_arn = get_queue_settings()
+    jobs = list(jobs)
+    task_names = {job['HITId']: job.get('task_name') for job in jobs}
+
+    for hit_type_id in sorted(set(filter(None, (job.get('HITTypeId') for job in jobs)))):
+        register_notifications(client, hit_type_id, queue_arn)
+
+    return watch_progress(client, sqs, queue_url, task_names,
+                          reconcile_every=reconcile_every, timeout=timeout)
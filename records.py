@@ -0,0 +1,167 @@
+from typing import Any, Dict, Iterator, Optional, Set, Tuple, Union
+from pathlib import Path
+import hashlib
+import logging
+import json
+import os
+import threading
+import yaml
+
+
+# Keys that MTurk sets on a HIT. Anything else in a job record comes from the sample.
+HIT_FIELDS = {
+    'HITId', 'HITTypeId', 'HITGroupId', 'HITLayoutId', 'CreationTime',
+    'Title', 'Description', 'Question', 'Keywords', 'HITStatus',
+    'MaxAssignments', 'Reward', 'AutoApprovalDelayInSeconds', 'Expiration',
+    'AssignmentDurationInSeconds', 'QualificationRequirements',
+    'HITReviewStatus', 'NumberOfAssignmentsPending',
+    'NumberOfAssignmentsAvailable', 'NumberOfAssignmentsCompleted',
+}
+
+
+def sample_fingerprint(sample: Dict[str, Any]) -> str:
+    """ Stable hash of a sample, independent of the key order """
+    payload = json.dumps(sample, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def record_fingerprint(job: Dict[str, Any]) -> str:
+    """ Fingerprint of the sample stored inside a job record """
+    if 'fingerprint' in job:
+        return job['fingerprint']
+    sample = {k: v for k, v in job.items()
+              if k not in HIT_FIELDS and k != 'task_name'}
+    return sample_fingerprint(sample)
+
+
+def journal_filename(job_filename: Union[Path, str]) -> Path:
+    """ The JSONL journal that goes with a (possibly legacy YAML) job file """
+    job_filename = Path(job_filename)
+    if job_filename.suffix in ('.yaml', '.yml'):
+        return job_filename.with_suffix('.jsonl')
+    return job_filename
+
+
+def migrate_yaml_records(yaml_file: Union[Path, str],
+                         journal: Union[Path, str]) -> int:
+    """ One-shot conversion of a legacy job.yaml into a JSONL journal """
+    with open(yaml_file, 'r') as ymlfile:
+        jobs = yaml.safe_load(ymlfile) or []
+
+    tmp_file = Path(str(journal) + '.tmp')
+    num_jobs = 0
+    with open(tmp_file, 'w') as fid:
+        for job in jobs:
+            if job is None:
+                continue
+            job = {**job, 'fingerprint': record_fingerprint(job)}
+            fid.write(json.dumps(job, default=str) + '\n')
+            num_jobs += 1
+        fid.flush()
+        os.fsync(fid.fileno())
+    os.replace(tmp_file, journal)
+
+    logging.info(f"Migrated {num_jobs} jobs from {yaml_file} to {journal}")
+    return num_jobs
+
+
+def iter_records(journal: Union[Path, str]) -> Iterator[Dict[str, Any]]:
+    """ Stream the job records of a journal """
+    if not Path(journal).is_file():
+        return
+    with open(journal, 'r') as fid:
+        for line in fid:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # A crash can leave a truncated last line behind
+                logging.warning(f"Skipping a corrupted line in {journal}")
+
+
+class JobJournal:
+    """ Append-only JSONL journal of submitted jobs
+
+    The (task_name, sample fingerprint) index is loaded once, so checking
+    for duplicates does not touch the disk.
+    """
+
+    def __init__(self, job_filename: Union[Path, str]):
+        self.legacy_file = Path(job_filename)
+        self.filename = journal_filename(job_filename)
+        self._index: Optional[Set[Tuple[str, str]]] = None
+        self._lock = threading.Lock()
+
+        if self.filename != self.legacy_file \
+                and self.legacy_file.is_file() \
+                and not self.filename.is_file():
+            migrate_yaml_records(self.legacy_file, self.filename)
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return iter_records(self.filename)
+
+    @property
+    def index(self) -> Set[Tuple[str, str]]:
+        if self._index is None:
+            self._index = {(job.get('task_name'), record_fingerprint(job))
+                           for job in self}
+        return self._index
+
+    def contains(self, task_name: str, sample: Dict[str, Any]) -> bool:
+        return (task_name, sample_fingerprint(sample)) in self.index
+
+    def append(self, job: Dict[str, Any], sample: Dict[str, Any]) -> Dict[str, Any]:
+        """ Write a job record and make sure it reached the disk """
+        job = {**job, 'fingerprint': sample_fingerprint(sample)}
+        with self._lock:
+            with open(self.filename, 'a') as fid:
+                fid.write(json.dumps(job, default=str) + '\n')
+                fid.flush()
+                os.fsync(fid.fileno())
+
+            if self._index is not None:
+                self._index.add((job.get('task_name'), job['fingerprint']))
+
+        return job
+
+
+_journals: Dict[Path, JobJournal] = {}
+
+
+def get_journal(job_filename: Union[Path, str]) -> JobJournal:
+    """ Share a single journal (and its index) across the process """
+    key = Path(job_filename)
+    if key not in _journals:
+        _journals[key] = JobJournal(key)
+    return _journals[key]
+
+
+class StateJournal:
+    """ Append-only JSONL journal of per-key states, for resumable bulk jobs
+
+    Each line is {"key": ..., "state": ..., ...}; the last line of a key wins.
+    """
+
+    def __init__(self, filename: Union[Path, str]):
+        self.filename = Path(filename)
+        self._lock = threading.Lock()
+        self.states: Dict[str, Dict[str, Any]] = {}
+        for entry in iter_records(self.filename):
+            self.states[entry['key']] = entry
+
+    def state(self, key: str) -> Optional[str]:
+        entry = self.states.get(key)
+        return None if entry is None else entry['state']
+
+    def append(self, key: str, state: str, **extra: Any) -> None:
+        """ Write the new state of a key and make sure it reached the disk """
+        entry = {'key': key, 'state': state, **extra}
+        line = json.dumps(entry, default=str) + '\n'
+        with self._lock:
+            with open(self.filename, 'a') as fid:
+                fid.write(line)
+                fid.flush()
+                os.fsync(fid.fileno())
+            self.states[key] = entry
@@ -0,0 +1,206 @@
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from pathlib import Path
+import csv
+import json
+import logging
+import re
+from botocore.exceptions import ClientError
+from tqdm.auto import tqdm
+from answers import decode_colors, decode_value
+from batch import chunked
+from config import get_config
+from records import StateJournal, get_journal
+from throttle import TokenBucket, call_with_backoff
+
+
+APPROVED = 'approved'
+REJECTED = 'rejected'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+# MTurk refused the decision: someone else reviewed the assignment first
+ALREADY_REVIEWED = 'already-reviewed'
+
+BUG = "bug"
+
+# Image of a check sample, see generators.check_generator
+CHECK_IMAGE = re.compile(r"tower_(\d+)_(\d+)_first\.jpg$")
+
+
+def get_review_journal() -> StateJournal:
+    return StateJournal(get_config().get('review_journal', 'review.jsonl'))
+
+
+class ReferenceAnswers:
+    """ Expected colors keyed by (num_cubes, ref), e.g. agreed check answers
+
+    Rows come from a JSONL file or a CSV file, with num_cubes (or numCubes),
+    ref and color (or ground_truth) fields.
+    """
+
+    def __init__(self, filename: Union[Path, str]):
+        self.colors: Dict[Tuple[int, int], Any] = {}
+        with open(filename, 'r', newline='') as fid:
+            rows = csv.DictReader(fid) if Path(filename).suffix == '.csv' \
+                else (json.loads(line) for line in fid if line.strip())
+            for row in rows:
+                num_cubes = row.get('num_cubes', row.get('numCubes'))
+                color = row.get('color', row.get('ground_truth'))
+                if isinstance(color, str):
+                    color = decode_value(color)
+                self.colors[(int(num_cubes), int(row['ref']))] = color
+
+    def get(self, num_cubes: int, ref: int) -> Any:
+        key = (int(num_cubes), int(ref))
+        if key not in self.colors:
+            raise ValueError(f"Can't find the annotation {num_cubes}/{ref}")
+        return self.colors[key]
+
+
+def sample_items(job: Dict[str, Any]) -> List[Tuple[str, str]]:
+    """ (num_cubes, ref) of each step of a HIT, from the sample stored with it
+
+    Grouped samples carry num_cubes0, ref0, num_cubes1, ... as written by
+    batch.write_groups; other samples a single num_cubes (or numCubes) and ref.
+    Check samples only have their tower in the image URL.
+    """
+    items = []
+    while f"num_cubes{len(items)}" in job:
+        items.append((job[f"num_cubes{len(items)}"], job[f"ref{len(items)}"]))
+    if not items:
+        num_cubes = job.get('num_cubes', job.get('numCubes'))
+        ref = job.get('ref', job.get('id'))
+        match = CHECK_IMAGE.search(str(job.get('image', '')))
+        if num_cubes is None and match is not None:
+            num_cubes, ref = match.groups()
+        if num_cubes is not None and ref is not None:
+            items.append((num_cubes, ref))
+    return items
+
+
+def answer_output(answers: Any) -> Any:
+    """ The output field of an answer, decoded """
+    if isinstance(answers, dict):
+        answers = answers['output'] if 'output' in answers \
+            else next(iter(answers.values()), None)
+    return decode_value(answers) if isinstance(answers, str) else answers
+
+
+def score_item(expected: Any, levels: Any) -> Optional[float]:
+    """ Fraction of the levels with the right color; None for a reported bug """
+    if levels == BUG or not isinstance(levels, list):
+        return None
+    expected = [str(color).lower() for color in expected]
+    answered = decode_colors(levels)
+    length = max(len(expected), len(answered))
+    if length == 0:
+        return None
+    return sum(a == e for a, e in zip(answered, expected)) / length
+
+
+def score_assignment(row: Dict[str, Any], job: Optional[Dict[str, Any]],
+                     reference: Any) -> Optional[float]:
+    """ Mean score over the steps of the HIT, or None if nothing can be scored """
+    if job is None:
+        return None
+    output = answer_output(row.get('answers', row.get('answer')))
+    if not isinstance(output, list):
+        return None
+
+    scores = []
+    for (num_cubes, ref), levels in zip(sample_items(job), output):
+        try:
+            expected = reference.get(num_cubes, ref)
+        except ValueError as err:
+            logging.warning(f"{row['assignment_id']}: {err}")
+            continue
+        score = score_item(expected, levels)
+        if score is not None:
+            scores.append(score)
+    return sum(scores) / len(scores) if scores else None
+
+
+def iter_results(filename: Union[Path, str]) -> Iterator[Dict[str, Any]]:
+    """ Stream the rows of a harvest output, CSV or JSONL """
+    with open(filename, 'r', newline='') as fid:
+        if Path(filename).suffix == '.csv':
+            yield from csv.DictReader(fid)
+        else:
+            for line in fid:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def review(client: Any,
+           results: Union[Path, str],
+           reference: Any,
+           min_score: float = 0.5,
+           message: str = "",
+           batch_size: int = 500,
+           workers: int = 16,
+           rate: float = 10.,
+           dry_run: bool = False) -> Dict[str, int]:
+    """ Approve or reject the submitted assignments of a harvest output
+
+    Assignments are scored batch by batch against the reference, and the
+    decisions of a batch are sent concurrently under the rate limit. The
+    journal records every decision, so a re-run only sends the missing ones.
+    Assignments that can't be scored are left to the auto-approval.
+    """
+    journal = get_review_journal()
+    jobs = {job['HITId']: job for job in get_journal(get_config()['job_filename'])}
+    bucket = TokenBucket(rate, burst=workers)
+    counts: Counter = Counter()
+
+    def decide(row: Dict[str, Any], score: float) -> str:
+        approve = score >= min_score
+        state = APPROVED if approve else REJECTED
+        if dry_run:
+            return state
+        try:
+            if approve:
+                call_with_backoff(client.approve_assignment,
+                                  AssignmentId=row['assignment_id'],
+                                  bucket=bucket)
+            else:
+                call_with_backoff(client.reject_assignment,
+                                  AssignmentId=row['assignment_id'],
+                                  RequesterFeedback=message,
+                                  bucket=bucket)
+        except ClientError as err:
+            if 'status of: submitted' not in str(err).lower():
+                logging.error(f"Can't review {row['assignment_id']}: {err}")
+                return FAILED
+            # Reviewed elsewhere, maybe the other way: don't record our decision
+            logging.warning(f"{row['assignment_id']} was already reviewed")
+            journal.append(row['assignment_id'], ALREADY_REVIEWED,
+                           worker_id=row['worker_id'], hit_id=row['hit_id'], score=score)
+            return ALREADY_REVIEWED
+        journal.append(row['assignment_id'], state, worker_id=row['worker_id'],
+                       hit_id=row['hit_id'], score=score)
+        return state
+
+    rows = (row for row in iter_results(results)
+            if row.get('status') == 'Submitted'
+            and journal.state(row['assignment_id']) not in (APPROVED, REJECTED,
+                                                            ALREADY_REVIEWED))
+    pbar = tqdm(unit='assignment')
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch in chunked(rows, batch_size):
+            futures = []
+            for row in batch:
+                score = score_assignment(row, jobs.get(row['hit_id']), reference)
+                if score is None:
+                    counts[SKIPPED] += 1
+                else:
+                    futures.append(executor.submit(decide, row, score))
+            for future in futures:
+                counts[future.result()] += 1
+            pbar.update(len(batch))
+    pbar.close()
+
+    logging.info(f"Reviewed {sum(counts.values())} assignments: {dict(counts)}"
+                 + (" (dry run)" if dry_run else ""))
+    return dict(counts)
@@ -1,62 +1,121 @@
+import hashlib
 import logging
-from typing import Dict, Any
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, Any, Iterable, List, Optional
 from pathlib import Path
-from jinja2 import Environment, FileSystemLoader
-import yaml
+from botocore.exceptions import ClientError
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, Template
 from aws import connect_mturk, list_bucket_objects
 from config import get_config
 from generators import retrieve_generator
+from records import get_journal, sample_fingerprint
+from batch import chunked
+from throttle import TokenBucket, call_with_backoff
+from hittypes import create_hit_type, get_hit_type_registry
+from inventory import get_inventory
 
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Returned for a token already used, with the HITId in the message
+HIT_ALREADY_EXISTS = 'AWS.MechanicalTurk.HitAlreadyExists'
+HIT_ID = re.compile(r"\b[A-Z0-9]{30}\b")
+
+@lru_cache(maxsize=None)
+def get_environment(template_folder: str = 'templates',
+                    cache_folder: Optional[str] = None) -> Environment:
+    """ A shared Jinja2 environment, with an optional on-disk bytecode cache """
+    bytecode_cache = None
+    if cache_folder is not None:
+        Path(cache_folder).mkdir(parents=True, exist_ok=True)
+        bytecode_cache = FileSystemBytecodeCache(cache_folder)
+    return Environment(loader=FileSystemLoader(template_folder),
+                       bytecode_cache=bytecode_cache)
+
+
+_templates: Dict[Any, Template] = {}
+
+
+def get_template(task: Dict[str, Any]) -> Template:
+    """ Compiled template of a task, loaded once per run """
+    key = (task['name'], task['template'])
+    if key not in _templates:
+        config = get_config()
+        env = get_environment(config.get('template_folder', 'templates'),
+                              config.get('template_cache'))
+        _templates[key] = env.get_template(task['template'])
+    return _templates[key]
+
+
 def generate_template(task: Dict[str, Any],
                       sample: Dict[str, str]) -> str:
-    env = Environment(loader=FileSystemLoader('templates'))
-    template = env.get_template(task['template'])
-    return template.render(**sample)
+    return get_template(task).render(**sample)
+
+
+def generate_templates(task: Dict[str, Any],
+                       samples: Iterable[Dict[str, str]]) -> List[str]:
+    """ Render a chunk of samples with a single template lookup """
+    template = get_template(task)
+    return [template.render(**sample) for sample in samples]
 
 
 
 def is_job_in_records(task_name: str, sample: Dict[str, str]) -> bool:
-    """ Check if we can find the job in the records """ 
+    """ Check if we can find the job in the records """
     config = get_config()
+    return get_journal(config['job_filename']).contains(task_name, sample)
 
-    if not Path(config['job_filename']).is_file():
-        return False
 
-    with open(config['job_filename'], 'r') as ymlfile:
-        jobs = yaml.safe_load(ymlfile)
+def hit_token(task_name: str, sample: Dict[str, Any]) -> str:
+    """ MTurk refuses a second HIT with the same token (for 24 hours) """
+    payload = f"{task_name}:{sample_fingerprint(sample)}"
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
 
-    for job in jobs:
-        if job is None:
-            continue
-        if not 'task_name' in job or job['task_name'] != task_name:
-            continue
-        if any([k in job.keys() for k in sample.keys()]):
-            continue
-        if all([job[key] == sample[key] for key in sample.keys()]):
-            return True
 
-    return False
+def existing_hit_id(err: ClientError) -> Optional[str]:
+    """ HITId of the HIT created earlier with the same token, if that is the error """
+    if err.response.get('TurkErrorCode') != HIT_ALREADY_EXISTS:
+        return None
+    match = HIT_ID.search(err.response.get('Error', {}).get('Message', ''))
+    return None if match is None else match.group()
 
 
-def create_job(client: Any,
-               task: Dict[str, Any],
-               sample: Dict) -> Dict[str, str]:
-    question = generate_template(task, sample)
+def post_job(client: Any,
+             task: Dict[str, Any],
+             sample: Dict,
+             question: Optional[str] = None,
+             allow_duplicate: bool = False) -> Dict[str, str]:
+    """ Create the HIT on MTurk without recording it
+
+    Unless duplicates are allowed, the HIT carries a token derived from the
+    sample, so a retried or replayed call can't post the sample twice: the
+    HIT created by the earlier call is returned instead.
+    """
+    if question is None:
+        question = generate_template(task, sample)
     config = get_config()
 
-    new_hit = client.create_hit(Title=task['title'],
-                                Description=task['description'],
-                                Keywords=task['keywords'],
-                                Reward=str(task['reward']),
-                                MaxAssignments=task['max_assignments'],
-                                LifetimeInSeconds=task['lifetime'],
-                                AssignmentDurationInSeconds=task['assignment_duration'],
-                                AutoApprovalDelayInSeconds=task['auto_approval_delay'],
-                                Question=question)
+    hit_type_id = get_hit_type_registry().get(client, task)
+    params = {} if allow_duplicate \
+        else {'UniqueRequestToken': hit_token(task['name'], sample)}
+    try:
+        new_hit = client.create_hit_with_hit_type(HITTypeId=hit_type_id,
+                                                  MaxAssignments=int(task['max_assignments']),
+                                                  LifetimeInSeconds=int(task['lifetime']),
+                                                  Question=question,
+                                                  **params)
+    except ClientError as err:
+        hit_id = existing_hit_id(err)
+        if hit_id is None:
+            raise
+        # An earlier call created the HIT, but it never reached the journal
+        logging.info(f"{hit_id} was already created for {sample}")
+        new_hit = client.get_hit(HITId=hit_id)
 
     preview_url = config['mturk']['preview_url'] + new_hit['HIT']['HITGroupId']
     hit_id = new_hit['HIT']['HITId']
@@ -66,30 +125,152 @@ def create_job(client: Any,
     logging.info(f"HIT Id {hit_id}")
 
     job = {**new_hit['HIT'], **sample, "task_name": task['name']}
-    del job['Question']
-
-    try:
-        with open(config['job_filename'], 'a') as ymlfile:
-            yaml.dump([job], ymlfile, default_flow_style=False)
-    except yaml.YAMLError as err:
-        logging.error(err)
+    job.pop('Question', None)
 
     return job
 
 
-def create_task(client: Any,
-                task: Dict[str, Any]):
+def create_job(client: Any,
+               task: Dict[str, Any],
+               sample: Dict,
+               question: Optional[str] = None) -> Dict[str, str]:
+    job = post_job(client, task, sample, question)
+    config = get_config()
+    return get_journal(config['job_filename']).append(job, sample)
 
+
+class LiveLimit:
+    """ Cap on the live HITs of a HIT type
+
+    The count comes from the local inventory: HITs created by this run are
+    added as they are recorded, and a list_hits sync, at most every
+    `poll_interval` seconds, picks up the HITs that completed or expired.
+    """
+
+    def __init__(self, client: Any, hit_type_id: str, max_live: int,
+                 poll_interval: float = 60.):
+        self.client = client
+        self.hit_type_id = hit_type_id
+        self.max_live = max_live
+        self.poll_interval = poll_interval
+        self.inventory = get_inventory()
+        self.synced_at = 0.
+        self.sync()
+
+    def sync(self) -> None:
+        self.inventory.sync(self.client)
+        self.synced_at = time.monotonic()
+
+    def live(self) -> int:
+        return self.inventory.count_live(self.hit_type_id)
+
+    def add(self, job: Dict[str, Any]) -> None:
+        self.inventory.update(job)
+
+    def wait(self) -> None:
+        """ Sleep until the next poll, then sync """
+        delay = self.synced_at + self.poll_interval - time.monotonic()
+        if delay > 0:
+            logging.info(f"{self.live()} HITs are live (max {self.max_live}), "
+                         f"next check in {delay:.0f}s")
+            time.sleep(delay)
+        self.sync()
+
+
+def submit_samples(client: Any,
+                   task: Dict[str, Any],
+                   samples: Iterable[Dict],
+                   workers: int = 8,
+                   rate: float = 5.,
+                   chunk_size: int = 50,
+                   allow_duplicate: bool = False,
+                   max_live: Optional[int] = None,
+                   poll_interval: float = 60.) -> int:
+    """ Submit samples concurrently under a rate limit
+
+    HITs are recorded in the order of the samples, as soon as all the
+    previous ones are recorded, so the journal never has gaps.
+    With max_live, at most that many HITs of the task are live at once:
+    the next sample waits until earlier HITs complete or expire.
+    Return the number of recorded HITs.
+    """
     config = get_config()
+    journal = get_journal(config['job_filename'])
+    bucket = TokenBucket(rate, burst=workers)
 
-    response = client.create_hit_type(Title=task['title'],
-                                      Description=task['description'],
-                                      Keywords=task['keywords'],
-                                      Reward=str(task['reward']),
-                                      AssignmentDurationInSeconds=task['assignment_duration'],
-                                      AutoApprovalDelayInSeconds=task['auto_approval_delay'])
+    # Validate the task and register its HIT type before sending anything
+    hit_type_id = get_hit_type_registry().get(client, task)
+    limit = None if max_live is None \
+        else LiveLimit(client, hit_type_id, max_live, poll_interval)
+    pending: deque = deque()
+    seen = set()
+    num_recorded = 0
+
+    def record_first():
+        nonlocal num_recorded
+        sample, future = pending.popleft()
+        if future.cancelled():
+            return
+        try:
+            job = future.result()
+        except Exception as err:
+            logging.error(f"Can't submit {sample}: {err}")
+            return
+        journal.append(job, sample)
+        if limit is not None:
+            limit.add(job)
+        num_recorded += 1
+
+    def wait_for_slot():
+        """ Block until one more HIT fits under max_live """
+        while True:
+            while pending and pending[0][1].done():
+                record_first()
+            # HITs being created are not in the inventory yet
+            if limit.live() + len(pending) < limit.max_live:
+                return
+            if pending:
+                record_first()
+            else:
+                limit.wait()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for chunk in chunked(samples, chunk_size):
+                chunk = [sample for sample in chunk
+                         if allow_duplicate
+                         or not (journal.contains(task['name'], sample)
+                                 or sample_fingerprint(sample) in seen)]
+                seen.update(sample_fingerprint(sample) for sample in chunk)
+                questions = generate_templates(task, chunk)
+
+                for sample, question in zip(chunk, questions):
+                    if limit is not None:
+                        wait_for_slot()
+                    future = executor.submit(call_with_backoff, post_job,
+                                             client, task, sample, question,
+                                             allow_duplicate, bucket=bucket)
+                    pending.append((sample, future))
+
+                    while len(pending) > 2 * workers \
+                            or (pending and pending[0][1].done()):
+                        record_first()
+        except BaseException:
+            # Stop sending, but record everything already sent
+            for _, future in pending:
+                future.cancel()
+            raise
+        finally:
+            while pending:
+                record_first()
+
+    return num_recorded
+
+
+def create_task(client: Any,
+                task: Dict[str, Any]):
 
-    return response
+    return create_hit_type(client, task)
 
 
 
@@ -0,0 +1,50 @@
+import json
+import sys
+from pathlib import Path
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import config
+import hittypes
+from fake_mturk import FakeMTurk
+from records import get_journal
+from submit import post_job, submit_samples
+
+
+@pytest.fixture
+def task(tmp_path, monkeypatch):
+    """ A config folder in a temporary directory, with one task """
+    (tmp_path / "templates").mkdir()
+    (tmp_path / "templates" / "task.html").write_text("<p>{{ id }}</p>")
+    (tmp_path / "config").mkdir()
+    settings = {
+        'job_filename': str(tmp_path / "jobs.jsonl"),
+        'hit_type_filename': str(tmp_path / "hit_types.json"),
+        'template_folder': str(tmp_path / "templates"),
+        'mturk': {'endpoint_url': 'https://fake', 'preview_url': 'https://preview/'},
+        'tasks': [{'name': 'towers', 'template': 'task.html', 'title': 't',
+                   'description': 'd', 'keywords': 'k', 'reward': 0.1,
+                   'max_assignments': 3, 'lifetime': 1000,
+                   'assignment_duration': 60, 'auto_approval_delay': 60}],
+    }
+    (tmp_path / "config" / "0.yaml").write_text(json.dumps(settings))
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(hittypes, '_registry', None)
+    config.reload_config()
+    return config.get_config()['tasks'][0]
+
+
+def test_rerun_after_crash_records_the_hit_once(task):
+    client = FakeMTurk()
+    samples = [{'id': str(i)} for i in range(5)]
+
+    # The process dies after creating the first HITs, before the journal write
+    for sample in samples[:2]:
+        post_job(client, task, sample)
+
+    assert submit_samples(client, task, samples, rate=0) == len(samples)
+
+    jobs = list(get_journal(config.get_config()['job_filename']))
+    assert len(client.hits) == len(samples)
+    assert sorted(job['HITId'] for job in jobs) == sorted(client.hits)
+    assert sorted(job['id'] for job in jobs) == [sample['id'] for sample in samples]
@@ -0,0 +1,88 @@
+from typing import Any, Callable, Optional
+import logging
+import random
+import sys
+import threading
+import time
+
+
+THROTTLING_CODES = {'ThrottlingException', 'Throttling',
+                    'TooManyRequestsException', 'ServiceUnavailable'}
+
+# Server-side failures worth another attempt
+TRANSIENT_CODES = {'ServiceFault', 'InternalError', 'InternalFailure',
+                   'RequestTimeout'}
+
+
+class TokenBucket:
+    """ Thread-safe token bucket: `rate` calls per second, bursts of `burst` """
+
+    def __init__(self, rate: float, burst: Optional[int] = None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1, int(rate))
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def error_code(err: Exception) -> str:
+    """ The AWS error code of a botocore ClientError, or '' """
+    response = getattr(err, 'response', None) or {}
+    return response.get('Error', {}).get('Code', '')
+
+
+def is_throttling(err: Exception) -> bool:
+    return error_code(err) in THROTTLING_CODES
+
+
+def is_retryable(err: Exception) -> bool:
+    """ Throttled, failed on the server side, or lost on the way """
+    if error_code(err) in THROTTLING_CODES | TRANSIENT_CODES:
+        return True
+    # Not loaded means the error can't come from botocore
+    exceptions = sys.modules.get('botocore.exceptions')
+    return exceptions is not None \
+        and isinstance(err, (exceptions.ConnectionError, exceptions.HTTPClientError))
+
+
+def call_with_backoff(func: Callable, *args: Any,
+                      bucket: Optional[TokenBucket] = None,
+                      max_retries: int = 8,
+                      base_delay: float = 0.5,
+                      max_delay: float = 30.,
+                      **kwargs: Any) -> Any:
+    """ Call `func` under the rate limit, retrying throttled and transient
+    failures with exponential backoff and full jitter
+
+    This is the only retry layer of the MTurk client, see clients.SERVICE_DEFAULTS.
+    """
+    for attempt in range(max_retries + 1):
+        if bucket is not None:
+            bucket.acquire()
+        try:
+            return func(*args, **kwargs)
+        except Exception as err:
+            if not is_retryable(err) or attempt == max_retries:
+                raise
+            # Imported here, since metrics uses THROTTLING_CODES
+            from metrics import get_metrics
+            get_metrics().record_retry()
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            logging.debug(f"{error_code(err) or type(err).__name__}, "
+                          f"retrying in {delay:.2f}s")
+            time.sleep(delay)
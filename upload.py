@@ -0,0 +1,81 @@
+from typing import Any, Dict, Iterable, Optional, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+import hashlib
+import logging
+import mimetypes
+import time
+from boto3.s3.transfer import TransferConfig
+from tqdm import tqdm
+from clients import make_client
+
+
+# Single-part uploads keep the ETag equal to the MD5 of the content
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=5 * 1024 ** 3,
+                                 use_threads=False)
+
+
+def md5_of(path: Union[Path, str]) -> str:
+    digest = hashlib.md5()
+    with open(path, 'rb') as fid:
+        for block in iter(lambda: fid.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def list_etags(client: Any, bucket_name: str, prefix: str = '') -> Dict[str, str]:
+    """ ETag of every object of the bucket, from one paginated listing """
+    etags = {}
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            etags[obj['Key']] = obj['ETag'].strip('"')
+    return etags
+
+
+def upload_files(files: Iterable[Tuple[Union[Path, str], str]],
+                 bucket_name: str,
+                 client: Optional[Any] = None,
+                 workers: int = 16) -> Dict[str, float]:
+    """ Upload (local file, key) pairs concurrently
+
+    Objects already in the bucket with the same content are skipped.
+    Without a client, one is made with a connection per worker and the
+    credentials boto3 finds, so this runs without the repo config.
+    """
+    if client is None:
+        client = make_client('s3', {'max_pool_connections': workers})
+
+    existing = list_etags(client, bucket_name)
+    todo = []
+    skipped = 0
+    for local_file, key in files:
+        if existing.get(key) == md5_of(local_file):
+            skipped += 1
+        else:
+            todo.append((Path(local_file), key))
+
+    def upload(local_file: Path, key: str) -> int:
+        content_type = mimetypes.guess_type(key)[0] or 'application/octet-stream'
+        client.upload_file(str(local_file), bucket_name, key,
+                           ExtraArgs={'ContentType': content_type},
+                           Config=TRANSFER_CONFIG)
+        return local_file.stat().st_size
+
+    start = time.perf_counter()
+    num_bytes = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(upload, *item) for item in todo]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            num_bytes += future.result()
+    elapsed = time.perf_counter() - start
+
+    stats = {'uploaded': len(todo),
+             'skipped': skipped,
+             'seconds': elapsed,
+             'files_per_second': len(todo) / elapsed if elapsed > 0 else 0.,
+             'megabytes_per_second': num_bytes / 1e6 / elapsed if elapsed > 0 else 0.}
+    logging.info(f"Uploaded {len(todo)} files ({skipped} already in {bucket_name}) "
+                 f"at {stats['files_per_second']:.1f} files/s, "
+                 f"{stats['megabytes_per_second']:.2f} MB/s")
+    return stats